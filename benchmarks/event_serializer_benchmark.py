@@ -0,0 +1,79 @@
+"""Microbenchmark of the template-based XmlEventSerializer against splunklib's Event.write_to.
+
+Run from the repository root:
+
+    python benchmarks/event_serializer_benchmark.py [event_count]
+
+Both paths serialize the same per-user CAP exemption events into an in-memory stream. The script first checks
+that both outputs are byte-for-byte identical, then reports the time each path takes.
+"""
+
+import io
+import json
+import os
+import sys
+import timeit
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'TA-microsoft_azure_cap_exempted_users', 'bin')
+sys.path.insert(0, BIN_DIR)
+
+import ta_microsoft_azure_cap_exempted_users_declare
+
+from splunklib.modularinput.event import Event
+
+import cap_exempted_users_collector as collector
+
+SOURCE = 'ms_aad_user:tenant_id:00000000-0000-0000-0000-000000000000'
+SOURCETYPE = 'azure:aad:user:capexempts'
+INDEX = 'main'
+
+
+def sample_events(count):
+    events = []
+    for i in range(count):
+        xu = {
+            'policyId': '2b31ac51-b855-40a5-a986-0a4ed23e9008',
+            'policyDisplayName': 'Require MFA <all users> & "guests" – v%d' % (i % 7),
+            'policyState': 'enabled',
+            'policyLastModifiedDateTime': '2024-07-04T10:00:00.0000000Z',
+            'excludedUserMemberOf': 'b8a1c3f2-61a4-4f61-9d3c-0c7f9a0e7d%02d' % (i % 100),
+            'excludedUserState': 'Excluded from Policy via Group',
+            'excludedUserId': '%08x-0000-4000-8000-%012x' % (i, i),
+        }
+        events.append(json.dumps(xu, separators=(',', ':'), ensure_ascii=(i % 2 == 0)))
+    return events
+
+
+def write_with_event_objects(events):
+    stream = io.StringIO()
+    for data in events:
+        Event(data=data, source=SOURCE, index=INDEX, sourcetype=SOURCETYPE).write_to(stream)
+    return stream.getvalue()
+
+
+def write_with_serializer(events):
+    stream = io.StringIO()
+    serializer = collector.XmlEventSerializer(source=SOURCE, sourcetype=SOURCETYPE, index=INDEX)
+    for data in events:
+        stream.write(serializer.serialize(data))
+    return stream.getvalue()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    events = sample_events(count)
+
+    if write_with_event_objects(events) != write_with_serializer(events):
+        sys.exit('Serializer output differs from Event.write_to output.')
+
+    baseline = min(timeit.repeat(lambda: write_with_event_objects(events), number=1, repeat=3))
+    template = min(timeit.repeat(lambda: write_with_serializer(events), number=1, repeat=3))
+
+    print(f'events:                 {count}')
+    print(f'Event.write_to:         {baseline:.3f}s ({count / baseline:,.0f} events/s)')
+    print(f'XmlEventSerializer:     {template:.3f}s ({count / template:,.0f} events/s)')
+    print(f'speedup:                {baseline / template:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Microbenchmark of the pre-serialized policy prefix against per-member json.dumps of the full event dict.
+
+Run from the repository root:
+
+    python benchmarks/member_event_json_benchmark.py [member_count]
+
+Both paths build the JSON text of the per-user CAP exemption events for one large excluded group under one
+policy. The script first checks that both outputs are identical, then reports the time each path takes.
+"""
+
+import json
+import os
+import sys
+import timeit
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'TA-microsoft_azure_cap_exempted_users', 'bin')
+sys.path.insert(0, BIN_DIR)
+
+import ta_microsoft_azure_cap_exempted_users_declare
+
+import cap_exempted_users_collector as collector
+
+POLICY = {
+    'policyId': '2b31ac51-b855-40a5-a986-0a4ed23e9008',
+    'policyDisplayName': 'Require MFA <all users> & "guests" – v1',
+    'policyState': 'enabled',
+    'policyLastModifiedDateTime': '2024-07-04T10:00:00.0000000Z',
+}
+MEMBER_OF = 'b8a1c3f2-61a4-4f61-9d3c-0c7f9a0e7d00'
+STATE = 'Excluded from Policy via Group'
+
+
+def sample_member_ids(count):
+    return ['%08x-0000-4000-8000-%012x' % (i, i) for i in range(count)]
+
+
+def build_with_json_dumps(member_ids):
+    events = []
+    for member_id in member_ids:
+        xu = {}
+        xu['policyId'] = POLICY['policyId']
+        xu['policyDisplayName'] = POLICY['policyDisplayName']
+        xu['policyState'] = POLICY['policyState']
+        xu['policyLastModifiedDateTime'] = POLICY['policyLastModifiedDateTime']
+        xu['excludedUserMemberOf'] = MEMBER_OF
+        xu['excludedUserState'] = STATE
+        xu['excludedUserId'] = member_id
+        events.append(json.dumps(xu, separators=(',', ':')))
+    return events
+
+
+def build_with_prefix(member_ids):
+    events = []
+    prefix = collector.member_event_prefix(POLICY, MEMBER_OF, STATE)
+    for member_id in member_ids:
+        events.append(prefix + collector.encode_json_string(member_id) + '}')
+    return events
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    member_ids = sample_member_ids(count)
+
+    if build_with_json_dumps(member_ids) != build_with_prefix(member_ids):
+        sys.exit('Prefix output differs from json.dumps output.')
+
+    baseline = min(timeit.repeat(lambda: build_with_json_dumps(member_ids), number=1, repeat=3))
+    prefix = min(timeit.repeat(lambda: build_with_prefix(member_ids), number=1, repeat=3))
+
+    print(f'members:                {count}')
+    print(f'json.dumps per member:  {baseline:.3f}s ({count / baseline:,.0f} events/s)')
+    print(f'policy prefix:          {prefix:.3f}s ({count / prefix:,.0f} events/s)')
+    print(f'speedup:                {baseline / prefix:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,20 @@
 [conditional_access_policy_exempted_users://<name>]
 policy_name = A valid RegEx patter to match policy names. A single period means retrieving everything.
 client_id = 
-tenant_id =
\ No newline at end of file
+tenant_id =
+max_concurrency = Maximum number of excluded groups whose members are fetched from Microsoft Graph in parallel. Defaults to 8.
+collection_mode = Full emits every member of every excluded group on each run. Delta emits every member once, then only the members added to or removed from excluded groups since the previous run. Snapshot reads every member like Full but compares each group with the member set saved by the previous run, and only emits the members added to or removed from it (including direct exclusions).
+expand_nested_groups = Resolve users who are members of excluded groups through nested groups. Nested groups are then not reported as members themselves. Only applies to the full and snapshot collection modes.
+page_size = Number of group members requested per Microsoft Graph page ($top), between 1 and 999. Defaults to 999.
+policy_fields = Full ingests complete policy objects as azure:aad:policy events. Minimal only requests and ingests id, displayName, state, modifiedDateTime and conditions.
+output_mode = Modular Input writes events to the modular input XML stream. HTTP Event Collector sends them to Splunk HEC in batched, pipelined requests.
+hec_input_name = Name of the HTTP Event Collector input used when Output Mode is HTTP Event Collector. It is created if it does not exist.
+hec_compression = Gzip-compress the requests sent to the HTTP Event Collector.
+event_schema = Per User writes one azure:aad:user:capexempts event per exempted user and policy. Aggregated writes one azure:aad:user:capexempts:aggregated event per policy and group, holding the member ids in excludedUserIds (split into chunks of at most 500 ids).
+user_summary = Also write one azure:aad:user:capexempts:summary event per exempted user at the end of each run, listing every policy and path (direct or group) that exempts the user. Full collection mode and unsharded inputs only; runs that resume, stop at their deadline or fail to read a group or role write no summary.
+policy_snapshot_interval = Seconds between full policy snapshots. When set, an azure:aad:policy event is only written for policies that are new or whose modifiedDateTime changed since the previous run, and every matched policy is written again once this interval has passed. Leave empty to write every matched policy on each run.
+enrich_directory_objects = Add the userPrincipalName, displayName and accountEnabled of each exempted user and the displayName of the excluded group to member events. Objects are resolved through Microsoft Graph directoryObjects/getByIds and cached for a day. Requires the Directory.Read.All application permission.
+resumable_collection = Full collection mode only. Save the groups already written and the next page link of the group in progress in the checkpoint store while the input runs, so a run that was stopped part-way resumes where it stopped. Member events then carry a collectionRunId, and an azure:aad:user:capexempts:run event marks the run as complete.
+max_runtime_seconds = Time budget of one run, in seconds. Work is done in order of priority: policies, directly excluded users, directory roles, then groups from the smallest to the largest. No new Microsoft Graph requests are started once the budget is nearly used up, and in the full collection mode the progress is saved so the next run continues with the groups left. Events keep their schema: collectionRunId and run events are only added by Resumable Collection. Leave empty for no limit.
+shard_count = Number of inputs that share the collection of this tenant. Each input collects only the excluded groups and directory roles whose id hashes into its shard. Each shard writes its own run events and collectionRunId, and the unique exempt user summary is not available. Leave empty for a single input.
+shard_index = Shard of this input, from 0 to Shard Count - 1. Only shard 0 writes policy events and directly excluded users.
@@ -60,6 +60,130 @@ fields = [
             max_len=8192, 
         )
     ), 
+    field.RestField(
+        'max_concurrency',
+        required=False,
+        encrypted=False,
+        default='8',
+        validator=validator.Pattern(
+            regex=r"""^[1-9]\d*$|^$""", 
+        )
+    ), 
+    field.RestField(
+        'collection_mode',
+        required=False,
+        encrypted=False,
+        default='full',
+        validator=None
+    ), 
+    field.RestField(
+        'expand_nested_groups',
+        required=False,
+        encrypted=False,
+        default=None,
+        validator=None
+    ), 
+    field.RestField(
+        'page_size',
+        required=False,
+        encrypted=False,
+        default='999',
+        validator=validator.Pattern(
+            regex=r"""^([1-9]\d{0,2})?$""", 
+        )
+    ), 
+    field.RestField(
+        'policy_fields',
+        required=False,
+        encrypted=False,
+        default='full',
+        validator=None
+    ), 
+    field.RestField(
+        'output_mode',
+        required=False,
+        encrypted=False,
+        default='modinput',
+        validator=None
+    ), 
+    field.RestField(
+        'hec_input_name',
+        required=False,
+        encrypted=False,
+        default='ta_microsoft_azure_cap_exempted_users',
+        validator=None
+    ), 
+    field.RestField(
+        'hec_compression',
+        required=False,
+        encrypted=False,
+        default=None,
+        validator=None
+    ), 
+    field.RestField(
+        'event_schema',
+        required=False,
+        encrypted=False,
+        default='per_user',
+        validator=None
+    ), 
+    field.RestField(
+        'user_summary',
+        required=False,
+        encrypted=False,
+        default=None,
+        validator=None
+    ), 
+    field.RestField(
+        'policy_snapshot_interval',
+        required=False,
+        encrypted=False,
+        default=None,
+        validator=validator.Pattern(
+            regex=r"""^\d+$|^$""", 
+        )
+    ), 
+    field.RestField(
+        'enrich_directory_objects',
+        required=False,
+        encrypted=False,
+        default=None,
+        validator=None
+    ), 
+    field.RestField(
+        'resumable_collection',
+        required=False,
+        encrypted=False,
+        default=None,
+        validator=None
+    ), 
+    field.RestField(
+        'max_runtime_seconds',
+        required=False,
+        encrypted=False,
+        default=None,
+        validator=validator.Pattern(
+            regex=r"""^[1-9]\d*$|^$""", 
+        )
+    ), 
+    field.RestField(
+        'shard_count',
+        required=False,
+        encrypted=False,
+        default=None,
+        validator=validator.Pattern(
+            regex=r"""^[1-9]\d*$|^$""", 
+        )
+    ), 
+    field.RestField(
+        'shard_index',
+        required=False,
+        encrypted=False,
+        default=None,
+        validator=validator.Pattern(
+            regex=r"""^\d+$|^$""", 
+        )
+    ), 
 
     field.RestField(
         'disabled',
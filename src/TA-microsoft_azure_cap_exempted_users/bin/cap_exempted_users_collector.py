@@ -0,0 +1,2394 @@
+# encoding = utf-8
+
+"""Collection of the users exempted from Conditional Access Policies through Microsoft Graph.
+
+The Graph client, the group member page stream, the event writers and the checkpoint classes used by
+input_module_conditional_access_policy_exempted_users.collect_events.
+"""
+
+import requests
+import json
+import re
+import io
+import os
+import time
+import base64
+import gzip
+import hashlib
+import queue
+import random
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from json.encoder import encode_basestring_ascii as encode_json_string
+from requests.adapters import HTTPAdapter
+from solnlib import credentials
+from solnlib import utils as sutils
+from solnlib.modular_input.event import HECEvent
+from solnlib.modular_input.event_writer import HECEventWriter
+from splunklib import binding
+
+DEFAULT_MAX_CONCURRENCY = 8
+# Microsoft Graph accepts at most 20 requests in a single JSON $batch call.
+GRAPH_BATCH_SIZE = 20
+# Member pages buffered per group while the writer is still busy with an earlier group.
+PAGE_BUFFER_SIZE = 2
+GRAPH_URL = 'https://graph.microsoft.com/v1.0/'
+# (connect, read) timeouts in seconds applied to every Graph and token request.
+DEFAULT_HTTP_TIMEOUT = (10, 120)
+# Cached access tokens are refreshed this many seconds before they expire.
+TOKEN_EXPIRY_MARGIN = 300
+# Realm of the access tokens cached in splunkd's credential storage (storage/passwords).
+ACCESS_TOKEN_REALM = 'cap_exempted_users_access_token'
+# Status codes Microsoft Graph uses to signal throttling or a temporarily overloaded service.
+THROTTLING_STATUS_CODES = (429, 503, 504)
+DEFAULT_MAX_RETRIES = 6
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 120
+COLLECTION_MODES = ('full', 'delta', 'snapshot')
+# Microsoft Graph returns at most 999 directory objects per page; its default is 100.
+MAX_PAGE_SIZE = 999
+# Bounds of one batch of serialized events written to the modular input stream with a single flush.
+EVENT_BATCH_MAX_EVENTS = 1000
+EVENT_BATCH_MAX_BYTES = 1024 * 1024
+EVENT_BATCH_MAX_SECONDS = 2
+# Events are handed to the writer thread in lists of WRITER_QUEUE_BATCH_EVENTS; once WRITER_QUEUE_MAX_BATCHES
+# lists are waiting, collection blocks until the writer catches up.
+WRITER_QUEUE_BATCH_EVENTS = 500
+WRITER_QUEUE_MAX_BATCHES = 16
+OUTPUT_MODES = ('modinput', 'hec')
+DEFAULT_HEC_INPUT_NAME = 'ta_microsoft_azure_cap_exempted_users'
+# Upper bound of one HEC request body before compression; HEC's own max_content_length applies if lower.
+HEC_BATCH_MAX_BYTES = 1000000
+# HEC requests allowed in flight at the same time before writers block.
+HEC_MAX_IN_FLIGHT = 4
+POLICY_FIELDS = ('full', 'minimal')
+EVENT_SCHEMAS = ('per_user', 'aggregated')
+AGGREGATED_SOURCETYPE = 'azure:aad:user:capexempts:aggregated'
+# Member ids per aggregated event. About 20 KB of JSON without enrichment.
+AGGREGATED_EVENT_MAX_MEMBERS = 500
+SUMMARY_SOURCETYPE = 'azure:aad:user:capexempts:summary'
+# Upper bound of the JSON of one aggregated or summary event, below the sourcetypes' TRUNCATE = 65536 in props.conf.
+EVENT_MAX_BYTES = 60000
+# States of member events whose excludedUserMemberOf is a group id, not a directory role template id.
+GROUP_STATES = ("Excluded from Policy via Group", "Added to Excluded Group", "Removed from Excluded Group")
+# Projection used by the minimal policy mode. conditions is the narrowest selectable property holding conditions.users.
+MINIMAL_POLICY_SELECT = 'id,displayName,state,modifiedDateTime,conditions'
+# groups/delta accepts at most 50 group ids in one id filter.
+DELTA_GROUP_FILTER_SIZE = 50
+SNAPSHOT_SAVE_BATCH_SIZE = 100
+RUN_PROGRESS_SAVE_SECONDS = 30
+# Progress older than this is not resumed; the run starts over with a new generation.
+RUN_PROGRESS_MAX_AGE = 86400
+RUN_SOURCETYPE = 'azure:aad:user:capexempts:run'
+# Share of max_runtime_seconds (at most DEADLINE_MARGIN_MAX_SECONDS) kept free for requests already in flight.
+DEADLINE_MARGIN_FRACTION = 0.1
+DEADLINE_MARGIN_MAX_SECONDS = 60
+# directoryObjects/getByIds accepts at most 1000 ids per call.
+GET_BY_IDS_BATCH_SIZE = 1000
+DIRECTORY_OBJECT_CACHE_TTL = 86400
+# The cache is split by the first character of the object id so that no checkpoint grows too large.
+DIRECTORY_OBJECT_CACHE_SHARDS = '0123456789abcdef'
+
+def get_max_concurrency(helper):
+    
+    max_concurrency = helper.get_arg('max_concurrency')
+    
+    if not max_concurrency:
+        return DEFAULT_MAX_CONCURRENCY
+    
+    return int(max_concurrency)
+
+def get_collection_mode(helper):
+    
+    return helper.get_arg('collection_mode') or 'full'
+
+def get_deadline(helper, started):
+    """Return the time after which no new Graph request is started, or None without max_runtime_seconds."""
+    
+    max_runtime_seconds = helper.get_arg('max_runtime_seconds')
+    
+    if not max_runtime_seconds:
+        return None
+    
+    max_runtime_seconds = int(max_runtime_seconds)
+    margin = min(max_runtime_seconds * DEADLINE_MARGIN_FRACTION, DEADLINE_MARGIN_MAX_SECONDS)
+    
+    return started + max_runtime_seconds - margin
+
+def deadline_passed(deadline):
+    
+    return deadline is not None and time.time() >= deadline
+
+def get_shard(helper):
+    """Return the (shard_index, shard_count) of the input, (0, 1) when it is not sharded."""
+    
+    shard_count = int(helper.get_arg('shard_count') or 1)
+    shard_index = int(helper.get_arg('shard_index') or 0)
+    
+    return shard_index, shard_count
+
+def batch_save_check_points(helper, states):
+    """Save a dict of checkpoint key to state in one batch.
+
+    AOB hands its argument straight to solnlib's Checkpointer.batch_update, which takes a list of
+    {'_key': ..., 'state': ...} documents, not the dict its own docstring describes.
+    """
+    
+    helper.batch_save_check_point([{'_key': key, 'state': state} for key, state in states.items()])
+
+def jump_consistent_hash(key, num_buckets):
+    """Map a 64-bit key to a bucket in [0, num_buckets) with jump consistent hashing (Lamping and Veach, 2014).
+
+    When num_buckets grows from n to n + 1, only about 1 / (n + 1) of the keys move to the new bucket, so
+    adding an input to a sharded tenant leaves most groups with the input that already collects them.
+    """
+    
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    
+    return b
+
+def shard_of(object_id, shard_count):
+    
+    key = int.from_bytes(hashlib.sha1(object_id.lower().encode('utf-8')).digest()[:8], 'big')
+    
+    return jump_consistent_hash(key, shard_count)
+
+def get_page_size(helper):
+    
+    page_size = helper.get_arg('page_size')
+    
+    if not page_size:
+        return MAX_PAGE_SIZE
+    
+    return min(int(page_size), MAX_PAGE_SIZE)
+
+def get_proxy_uri(helper):
+    
+    proxy = helper.get_proxy()
+    
+    if not proxy or not proxy.get('proxy_url') or not proxy.get('proxy_type'):
+        return None
+    
+    proxy_type = proxy['proxy_type']
+    if proxy_type == 'socks5' and sutils.is_true(proxy.get('proxy_rdns')):
+        proxy_type = 'socks5h'
+    
+    uri = proxy['proxy_url']
+    if proxy.get('proxy_port'):
+        uri = f"{uri}:{proxy['proxy_port']}"
+    if proxy.get('proxy_username') and proxy.get('proxy_password'):
+        uri = f"{proxy['proxy_username']}:{proxy['proxy_password']}@{uri}"
+    
+    return f'{proxy_type}://{uri}'
+
+def parse_retry_after(value):
+    """Parse a Retry-After header given either as delay-seconds or as an HTTP-date. Returns seconds or None."""
+    
+    if not value:
+        return None
+    
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+class GraphRateController(object):
+    """Adaptive limiter shared by every Microsoft Graph call of a collection run.
+
+    Concurrency follows AIMD: each successful call grows the allowed number of in-flight requests by roughly one
+    per window, up to max_concurrency, and each throttling signal halves it. A throttled call also pauses every
+    worker for the Retry-After delay, or for a jittered exponential backoff when Graph does not send one.
+    """
+
+    def __init__(self, max_concurrency, max_retries=DEFAULT_MAX_RETRIES):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait = self.paused_until - time.time()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                self.condition.wait(wait if wait > 0 else None)
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            if self.limit < self.max_concurrency:
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+                self.condition.notify_all()
+
+    def on_throttle(self, attempt, retry_after=None):
+        """Shrink concurrency, pause all workers and return the delay applied before the next attempt."""
+        if retry_after is None:
+            # Full jitter keeps throttled workers from retrying in lockstep.
+            delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+        else:
+            delay = retry_after + random.uniform(0, BACKOFF_BASE_SECONDS)
+        with self.condition:
+            self.limit = max(1.0, self.limit / 2)
+            self.paused_until = max(self.paused_until, time.time() + delay)
+        return delay
+
+class GraphClient(object):
+    """Pooled, keep-alive HTTP client shared by every token and Microsoft Graph call of a collection run.
+
+    All requests go through one requests.Session so TCP and TLS connections are reused across pages and
+    across worker threads. Relative URLs are resolved against GRAPH_URL, and only Graph requests carry the
+    bearer token. Graph requests go through a GraphRateController, which retries throttled and failed calls.
+    """
+
+    def __init__(self, helper, pool_size=DEFAULT_MAX_CONCURRENCY, timeout=DEFAULT_HTTP_TIMEOUT):
+        self.helper = helper
+        self.timeout = timeout
+        self.access_token = None
+        self.expires_on = None
+        self.token_provider = None
+        self.token_lock = threading.Lock()
+        self.rate_controller = GraphRateController(pool_size)
+        # Retries that would wait past the deadline of the run are given up.
+        self.deadline = None
+        self.session = requests.Session()
+        
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        
+        proxy_uri = get_proxy_uri(helper)
+        if proxy_uri:
+            self.session.proxies = {'http': proxy_uri, 'https': proxy_uri}
+
+    def set_access_token(self, access_token, expires_on=None, token_provider=None):
+        """Set the bearer token used for Graph requests.
+
+        When expires_on and token_provider are given, the token is refreshed through token_provider() shortly
+        before it expires, so runs longer than the token lifetime keep going. token_provider returns a new
+        (access_token, expires_on) tuple, or (None, None) if no token could be obtained.
+        """
+        self.access_token = access_token
+        self.expires_on = expires_on
+        self.token_provider = token_provider
+
+    def refresh_access_token_if_expiring(self):
+        if self.token_provider is None or self.expires_on is None:
+            return
+        if time.time() < self.expires_on - TOKEN_EXPIRY_MARGIN:
+            return
+        with self.token_lock:
+            # Another worker may have refreshed it while this one was waiting for the lock.
+            if time.time() < self.expires_on - TOKEN_EXPIRY_MARGIN:
+                return
+            access_token, expires_on = self.token_provider()
+            if access_token is not None:
+                self.access_token = access_token
+                self.expires_on = expires_on
+
+    def request(self, method, url, **kwargs):
+        if not url.startswith('https://'):
+            url = GRAPH_URL + url
+        kwargs.setdefault('timeout', self.timeout)
+        if not url.startswith(GRAPH_URL):
+            return self.session.request(method, url, **kwargs)
+        
+        extra_headers = kwargs.pop('headers', None) or {}
+        attempt = 0
+        
+        while True:
+            self.refresh_access_token_if_expiring()
+            headers = {
+                'Authorization': 'Bearer ' + self.access_token,
+                'Content-Type': 'application/json'
+            }
+            headers.update(extra_headers)
+            
+            self.rate_controller.acquire()
+            try:
+                response = self.session.request(method, url, headers=headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.rate_controller.max_retries:
+                    raise
+                delay = self.rate_controller.on_throttle(attempt)
+                if self.deadline is not None and time.time() + delay >= self.deadline:
+                    raise
+                self.helper.log_warning(f'Graph request failed: {e}. Retrying in {delay:.1f}s (attempt {attempt + 1}).')
+                attempt += 1
+                continue
+            finally:
+                self.rate_controller.release()
+            
+            if response.status_code not in THROTTLING_STATUS_CODES:
+                self.rate_controller.on_success()
+                return response
+            
+            if attempt >= self.rate_controller.max_retries:
+                self.helper.log_error(f'Graph request still throttled after {attempt} retries. Status={response.status_code} url={url}')
+                return response
+            
+            delay = self.rate_controller.on_throttle(attempt, parse_retry_after(response.headers.get('Retry-After')))
+            if self.deadline is not None and time.time() + delay >= self.deadline:
+                self.helper.log_warning(f'Graph throttled the request. Status={response.status_code}. Not retrying, the run deadline would pass. url={url}')
+                return response
+            self.helper.log_warning(f'Graph throttled the request. Status={response.status_code}. Retrying in {delay:.1f}s (attempt {attempt + 1}).')
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+def get_token_credential_manager(helper):
+    
+    scheme, host, port = sutils.extract_http_scheme_host_port(helper.context_meta['server_uri'])
+    
+    return credentials.CredentialManager(helper.context_meta['session_key'], helper.get_app_name(), realm=ACCESS_TOKEN_REALM,
+                                         scheme=scheme, host=host, port=port)
+
+def token_fingerprint(access_token):
+    
+    return hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+
+def request_bearer_token(helper, client, client_id, client_secret, tenant_id):
+    
+    token_url = f'https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token'
+    
+    data = {
+        'grant_type': 'client_credentials',
+        'client_id': client_id,
+        'client_secret': client_secret,
+        'scope': 'https://graph.microsoft.com/.default'
+    }
+    
+    try:
+        
+        helper.log_info("Obtaining access token...")
+        
+        response = client.post(token_url, data=data)
+        response.raise_for_status()
+        token_info = response.json()
+        
+        helper.log_info(f"Access token for client id {client_id} has been granted...")
+        
+        return token_info
+    except requests.RequestException as e:
+        helper.log_error(f"Error obtaining token: {e}")
+        return None
+
+def get_bearer_token(helper, client, client_id, client_secret, tenant_id):
+    """Return an (access_token, expires_on) tuple, reusing the cached token while it is still valid for more than
+    TOKEN_EXPIRY_MARGIN seconds. Returns (None, None) if no token could be obtained.
+
+    The token is kept in splunkd's encrypted credential storage and the checkpoint store only holds its expiry
+    and a SHA-256 fingerprint. Both are keyed by (tenant_id, client_id) so every input sharing an app
+    registration shares the token. Inputs refreshing the token at the same time may interleave the parts of the
+    stored credential, so a token whose fingerprint does not match is not used.
+    """
+    
+    ckpt_key = f'access_token_{tenant_id}_{client_id}'
+    credential_name = f'{tenant_id}_{client_id}'
+    
+    try:
+        cached = helper.get_check_point(ckpt_key)
+    except Exception as e:
+        helper.log_warning(f'Unable to read the cached access token. Requesting a new one. {e}')
+        cached = None
+    
+    if cached and time.time() < cached.get('expires_on', 0) - TOKEN_EXPIRY_MARGIN:
+        try:
+            access_token = get_token_credential_manager(helper).get_password(credential_name)
+        except Exception as e:
+            helper.log_warning(f'Unable to read the cached access token. Requesting a new one. {e}')
+            access_token = None
+        if access_token is not None and token_fingerprint(access_token) == cached.get('fingerprint'):
+            helper.log_info(f"Reusing cached access token for client id {client_id}.")
+            return access_token, cached['expires_on']
+    
+    token_info = request_bearer_token(helper, client, client_id, client_secret, tenant_id)
+    
+    if token_info is None:
+        return None, None
+    
+    access_token = token_info['access_token']
+    expires_on = int(time.time()) + int(token_info.get('expires_in', 3599))
+    
+    try:
+        get_token_credential_manager(helper).set_password(credential_name, access_token)
+        helper.save_check_point(ckpt_key, {'expires_on': expires_on, 'fingerprint': token_fingerprint(access_token)})
+    except Exception as e:
+        helper.log_warning(f'Unable to cache the access token. {e}')
+    
+    return access_token, expires_on
+
+def get_conditional_access_policies(helper, client, policyNameRegex, policy_fields='full'):
+    
+    conditional_policy_url = 'identity/conditionalAccess/policies'
+    
+    if policy_fields == 'minimal':
+        conditional_policy_url += f'?$select={MINIMAL_POLICY_SELECT}'
+    
+    policies = []
+    policies_reduced = []
+    
+    helper.log_info(f'Retrieving Conditional Access Policies matching regex={policyNameRegex}')
+    
+    response = client.get(conditional_policy_url)
+    
+    if response.status_code == 200:
+            
+        policies = response.json()
+        policies_reduced.extend(policies['value'])
+        
+        while '@odata.nextLink' in policies:
+            next_link = policies['@odata.nextLink']
+            response_next_page = client.get(next_link)
+            if response_next_page.status_code == 200:
+                policies = response_next_page.json()
+                policies_reduced.extend(policies['value'])
+            else:
+                helper.log_error(f'Error occurred. status_code={str(response_next_page.status_code)} {response_next_page.text}')
+                break
+        
+        filtered_policies_reduced = [item for item in policies_reduced if re.search(policyNameRegex, item.get('displayName', ''), re.IGNORECASE)]
+        
+        return filtered_policies_reduced
+        
+        helper.log_info(f'All conditional access policies in cache. count={len(policies_reduced)}')
+            
+    else:
+        helper.log_error(f'Error occurred. status_code={str(response.status_code)} {response.text}')
+ 
+def get_excluded_groups_from_cap(helper, policies):
+    
+    if policies is None: 
+        helper.log_warning(f'Unable to retrieve excluded groups because policies list is empty.')
+        return
+    
+    groups = []
+    
+    for p in policies:
+        for g in p['conditions']['users']['excludeGroups']:
+            xg = {}
+            xg['policyId'] = p['id']
+            xg['policyDisplayName'] = p['displayName']
+            xg['policyState'] = p['state']
+            xg['policyLastModifiedDateTime'] = p['modifiedDateTime']
+            xg['excludedGroups'] = g
+            groups.append(xg)
+    
+    return groups
+    
+def get_excluded_roles_from_cap(helper, policies):
+    
+    if policies is None: 
+        helper.log_warning(f'Unable to retrieve excluded roles because policies list is empty.')
+        return
+    
+    roles = []
+    
+    for p in policies:
+        for r in p['conditions']['users'].get('excludeRoles') or []:
+            xr = {}
+            xr['policyId'] = p['id']
+            xr['policyDisplayName'] = p['displayName']
+            xr['policyState'] = p['state']
+            xr['policyLastModifiedDateTime'] = p['modifiedDateTime']
+            xr['excludedRoles'] = r
+            roles.append(xr)
+    
+    return roles
+    
+def get_excluded_users_from_cap(helper, policies):
+    
+    if policies is None: 
+        helper.log_warning(f'Unable to retrieve excluded users because policies list is empty.')
+        return
+    
+    users = []
+    
+    for p in policies:
+        for u in p['conditions']['users']['excludeUsers']:
+            xu = {}
+            xu['policyId'] = p['id']
+            xu['policyDisplayName'] = p['displayName']
+            xu['policyState'] = p['state']
+            xu['policyLastModifiedDateTime'] = p['modifiedDateTime']
+            xu['excludedUserMemberOf'] = "null"
+            xu['excludedUserState'] = "Excluded from Policy Directly"
+            xu['excludedUserId'] = u
+            users.append(xu)
+    
+    return users
+
+def get_group_members_url(group_id, transitive=False, page_size=MAX_PAGE_SIZE):
+    """Relative Graph URL of a group's members.
+
+    Direct members include nested groups as plain members. Transitive mode asks Graph to expand nested groups
+    server-side and cast the result to users, so every user is resolved once per top-level group, nested groups
+    are never reported as users and membership cycles are handled by Graph.
+    """
+    
+    if transitive:
+        return f'groups/{group_id}/transitiveMembers/microsoft.graph.user?$select=id&$top={page_size}'
+    
+    return f'groups/{group_id}/members?$select=id&$top={page_size}'
+
+def iter_group_member_pages(helper, client, group_id, transitive=False, page_size=MAX_PAGE_SIZE, first_page=None, start_link=None):
+    """Yield the member pages of a group one at a time, following @odata.nextLink as each page arrives.
+
+    Pages are the Graph response bodies, with the members in 'value'. first_page is an already retrieved first
+    page, e.g. from a $batch call. start_link is a saved @odata.nextLink to resume from; if it is no longer
+    accepted, the group is read from its first page. Errors are logged and end the iteration, so a failing
+    group yields no pages or only the pages read before the failure. The generator returns True once the last
+    page was read and False after an error.
+    """
+    
+    if first_page is None and start_link:
+        
+        helper.log_info(f"Resuming members of {group_id} from a saved page link")
+        
+        response = client.get(start_link)
+        
+        if response.status_code == 200:
+            first_page = response.json()
+        else:
+            helper.log_warning(f'Saved page link of group {group_id} was not accepted. Status={str(response.status_code)}. Reading the group from its first page.')
+    
+    if first_page is None:
+        
+        helper.log_info(f"Retrieving members of {group_id}")
+        
+        response = client.get(get_group_members_url(group_id, transitive, page_size))
+        
+        if response.status_code != 200:
+            helper.log_error(f'Error occurred. Status={str(response.status_code)} {response.text}. Members of group {group_id} could not be retrieved.')
+            return False
+        
+        first_page = response.json()
+    
+    group_members_details = first_page
+    page_counter = 1
+    
+    yield group_members_details
+    
+    while '@odata.nextLink' in group_members_details:
+        
+        page_counter = page_counter + 1
+        
+        if page_counter == 2:
+            helper.log_debug(f"Group {group_id} has multiple pages.")
+        
+        next_link = group_members_details['@odata.nextLink']
+        response = client.get(next_link)
+        if response.status_code == 200:
+            group_members_details = response.json()
+            yield group_members_details
+        else:
+            # The client has already retried; requesting the same page again would only loop.
+            helper.log_error(f'Error occurred. Status={str(response.status_code)} {response.text}. Members of group {group_id} are incomplete after page {str(page_counter - 1)}.')
+            return False
+    
+    if page_counter > 1:
+        helper.log_info(f"Group {group_id} ended collecting all members at page {str(page_counter)}.")
+    
+    return True
+
+def get_group_first_pages_batch(helper, client, group_ids, transitive=False, page_size=MAX_PAGE_SIZE):
+    """Retrieve the first member page of up to GRAPH_BATCH_SIZE groups in one JSON $batch call.
+
+    Returns a dict of group id -> first page. Groups whose sub-request failed are left out, so the caller
+    retrieves them on their own through iter_group_member_pages.
+    """
+    
+    batch_url = '$batch'
+    
+    batch_request = {
+        'requests': [
+            {'id': str(i), 'method': 'GET', 'url': '/' + get_group_members_url(gid, transitive, page_size)} for i, gid in enumerate(group_ids)
+        ]
+    }
+    
+    helper.log_info(f"Retrieving members of {len(group_ids)} groups in one batch request")
+    
+    response = client.post(batch_url, json=batch_request)
+    
+    if response.status_code != 200:
+        helper.log_error(f'Batch request failed. Status={str(response.status_code)} {response.text}. Retrieving groups one by one.')
+        return {}
+    
+    first_pages = {}
+    
+    for sub_response in response.json().get('responses', []):
+        gid = group_ids[int(sub_response['id'])]
+        if sub_response.get('status') == 200:
+            first_pages[gid] = sub_response['body']
+        else:
+            if sub_response.get('status') in THROTTLING_STATUS_CODES:
+                retry_after = parse_retry_after((sub_response.get('headers') or {}).get('Retry-After'))
+                client.rate_controller.on_throttle(0, retry_after)
+            helper.log_warning(f'Batch sub-request for group {gid} failed. Status={sub_response.get("status")}. Retrying on its own.')
+    
+    return first_pages
+
+class OrderedGroupPageStream(object):
+    """Fetch the member pages of many groups in parallel and hand them back group by group, in order.
+
+    Workers take GRAPH_BATCH_SIZE groups at a time, read their first pages through one $batch call and then
+    follow each group's pagination. Every group has its own queue of at most PAGE_BUFFER_SIZE pages and a worker
+    blocks while that queue is full, so memory stays flat however large the groups are, while the consumer
+    writes the pages of the current group as soon as they arrive.
+
+    Iterating yields (group_id, pages) tuples, where pages is an iterator over the member lists of that group.
+    Once pages is exhausted, incomplete_groups tells whether the group could only be read partially.
+    start_links maps group ids to saved @odata.nextLink values to resume from, and next_link() returns the
+    link that follows the page handed out last, for saving the progress of a run. Once deadline has passed no
+    new page is requested, and the groups not read by then are reported as incomplete.
+    """
+
+    END_OF_GROUP = object()
+    INCOMPLETE_GROUP = object()
+
+    def __init__(self, helper, client, group_ids, max_concurrency, transitive=False, page_size=MAX_PAGE_SIZE, start_links=None, deadline=None):
+        self.helper = helper
+        self.client = client
+        self.group_ids = list(group_ids)
+        self.max_concurrency = max_concurrency
+        self.transitive = transitive
+        self.page_size = page_size
+        self.queues = {gid: queue.Queue(maxsize=PAGE_BUFFER_SIZE) for gid in self.group_ids}
+        self.cancelled = threading.Event()
+        self.incomplete_groups = set()
+        self.start_links = start_links or {}
+        self.next_links = {}
+        self.deadline = deadline
+
+    def put(self, group_id, item):
+        while not self.cancelled.is_set():
+            try:
+                self.queues[group_id].put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch_chunk(self, chunk):
+        
+        if deadline_passed(self.deadline):
+            for gid in chunk:
+                self.put(gid, self.INCOMPLETE_GROUP)
+            return
+        
+        try:
+            batch_ids = [gid for gid in chunk if gid not in self.start_links]
+            first_pages = get_group_first_pages_batch(self.helper, self.client, batch_ids, self.transitive, self.page_size) if batch_ids else {}
+        except Exception as e:
+            self.helper.log_error(f'Batch request failed: {e}. Retrieving groups one by one.')
+            first_pages = {}
+        
+        for gid in chunk:
+            complete = False
+            try:
+                first_page = first_pages.pop(gid, None)
+                pages = iter_group_member_pages(self.helper, self.client, gid, self.transitive, self.page_size, first_page, self.start_links.get(gid))
+                # The next page needs a request unless it is the first page from the $batch call, or the group ends.
+                page = first_page and {}
+                while True:
+                    if (page is None or '@odata.nextLink' in page) and deadline_passed(self.deadline):
+                        break
+                    try:
+                        page = next(pages)
+                    except StopIteration as stop:
+                        complete = stop.value
+                        break
+                    if not self.put(gid, page):
+                        return
+            except Exception as e:
+                self.helper.log_error(f'Error occurred while retrieving members of group {gid}: {e}')
+            finally:
+                self.put(gid, self.END_OF_GROUP if complete else self.INCOMPLETE_GROUP)
+
+    def iter_pages(self, group_id):
+        while True:
+            page = self.queues[group_id].get()
+            if page is self.END_OF_GROUP:
+                return
+            if page is self.INCOMPLETE_GROUP:
+                self.incomplete_groups.add(group_id)
+                return
+            self.next_links[group_id] = page.get('@odata.nextLink')
+            yield page['value']
+
+    def next_link(self, group_id):
+        return self.next_links.get(group_id)
+
+    def __iter__(self):
+        
+        group_chunks = [self.group_ids[i:i + GRAPH_BATCH_SIZE] for i in range(0, len(self.group_ids), GRAPH_BATCH_SIZE)]
+        
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        
+        try:
+            # Chunks start in submission order, so the group being consumed always has a running worker.
+            for chunk in group_chunks:
+                executor.submit(self.fetch_chunk, chunk)
+            
+            for gid in self.group_ids:
+                pages = self.iter_pages(gid)
+                yield gid, pages
+                # Drain whatever the consumer left behind so the worker can move on.
+                for _ in pages:
+                    pass
+        finally:
+            self.cancelled.set()
+            executor.shutdown(wait=True)
+
+def pack_guid(object_id):
+    """Return a directory object id in its packed 16-byte form (uuid.UUID(object_id).bytes).
+
+    Member sets held across pages, groups or runs store packed ids: 16 bytes instead of a 36-character str,
+    and cheaper to hash and compare. Ids that are not GUIDs are kept as they are.
+    """
+    
+    if len(object_id) == 36:
+        try:
+            return bytes.fromhex(object_id.replace('-', ''))
+        except ValueError:
+            pass
+    return object_id
+
+def unpack_guid(packed):
+    """Return the canonical string form of an id packed by pack_guid."""
+    
+    if not isinstance(packed, bytes):
+        return packed
+    h = packed.hex()
+    return f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+
+def unpack_guids(packed_ids):
+    """Return the string ids of a packed member set, in a stable order."""
+    
+    return [unpack_guid(m) for m in sorted(packed_ids, key=lambda m: (isinstance(m, str), m))]
+
+def get_group_member_changes(helper, client, group_ids, delta_link=None):
+    """Run a groups/delta query with members@delta for up to DELTA_GROUP_FILTER_SIZE groups.
+
+    Without a delta_link, or when the saved one has expired, the query starts a new baseline and every current
+    member is reported as added. Returns a (changes, delta_link, is_baseline) tuple where changes maps each group
+    id to {'added': set(), 'removed': set()} of packed member ids, or (None, None, False) if the query failed.
+    A member reported on several pages ends up in the set of its last report.
+    """
+    
+    is_baseline = delta_link is None
+    
+    if delta_link:
+        response = client.get(delta_link)
+        if response.status_code in (400, 410):
+            helper.log_warning(f'Delta link expired or invalid. Status={str(response.status_code)}. Starting a new baseline for {len(group_ids)} groups.')
+            is_baseline = True
+    
+    if is_baseline:
+        id_filter = ' or '.join(f"id eq '{gid}'" for gid in group_ids)
+        response = client.get('groups/delta', params={'$filter': id_filter, '$select': 'members'})
+    
+    changes = {gid: {'added': set(), 'removed': set()} for gid in group_ids}
+    
+    while True:
+        
+        if response.status_code != 200:
+            helper.log_error(f'Error occurred. Status={str(response.status_code)} {response.text}')
+            return None, None, False
+        
+        page = response.json()
+        
+        for group in page.get('value', []):
+            group_changes = changes.setdefault(group['id'], {'added': set(), 'removed': set()})
+            added = group_changes['added']
+            removed = group_changes['removed']
+            for member in group.get('members@delta', []):
+                member_id = pack_guid(member['id'])
+                if '@removed' in member:
+                    added.discard(member_id)
+                    removed.add(member_id)
+                else:
+                    removed.discard(member_id)
+                    added.add(member_id)
+        
+        if '@odata.nextLink' not in page:
+            return changes, page.get('@odata.deltaLink'), is_baseline
+        
+        response = client.get(page['@odata.nextLink'])
+
+def encode_member_set(members):
+    """Return a packed member set as a JSON-serializable dict for the checkpoint store.
+
+    GUIDs are concatenated in sorted order and base64 encoded, about 22 bytes per member. Ids that are not
+    GUIDs are kept in a sorted list.
+    """
+    
+    packed = sorted(m for m in members if isinstance(m, bytes))
+    other = sorted(m for m in members if not isinstance(m, bytes))
+    
+    return {'packed': base64.b64encode(b''.join(packed)).decode('ascii'), 'other': other}
+
+def decode_member_set(encoded):
+    
+    data = base64.b64decode(encoded.get('packed', ''))
+    members = {data[i:i + 16] for i in range(0, len(data), 16)}
+    members.update(encoded.get('other', []))
+    
+    return members
+
+def member_set_fingerprint(members):
+    """SHA-1 of the sorted packed member ids, the same for the same membership whatever the page order."""
+    
+    digest = hashlib.sha1(b''.join(sorted(m for m in members if isinstance(m, bytes))))
+    for m in sorted(m for m in members if not isinstance(m, bytes)):
+        digest.update(b'\n' + m.encode('utf-8'))
+    
+    return digest.hexdigest()
+
+def get_policy_entry(p):
+    """Return the policy fields every member event starts with, from a Conditional Access Policy."""
+    
+    xp = {}
+    xp['policyId'] = p['id']
+    xp['policyDisplayName'] = p['displayName']
+    xp['policyState'] = p['state']
+    xp['policyLastModifiedDateTime'] = p['modifiedDateTime']
+    
+    return xp
+
+class MembershipSnapshots(object):
+    """Member sets saved by the previous run, compared with the current ones by the snapshot collection mode.
+
+    Each exclusion path (an excluded group or directory role, or the direct exclusions of one policy) has a
+    checkpoint holding the fingerprint of its member set, the member set itself and the policies its members
+    were written for. When the fingerprint is unchanged nothing is written. Otherwise only the members added or
+    removed since the previous run are written. A policy that did not reference the path in the previous run
+    gets every member, and a policy that no longer references it gets every previous member as removed.
+
+    The keys of all saved paths are kept in an index checkpoint. Paths no longer referenced by any policy are
+    written as removed by remove_unreferenced() and their checkpoints are deleted, so a path excluded again
+    later is written in full. Checkpoint changes are kept in memory and saved by save() once the events have
+    been written.
+    """
+
+    def __init__(self, helper, policies=()):
+        self.helper = helper
+        self.prefix = f'{helper.get_input_stanza_names()}_snapshot_'
+        self.index_ckpt_key = f'{helper.get_input_stanza_names()}_snapshot_index'
+        # Current fields of the matched policies, for the removals written for paths a policy no longer references.
+        self.policies = {p['id']: get_policy_entry(p) for p in policies}
+        self.known = set((helper.get_check_point(self.index_ckpt_key) or {}).get('keys', []))
+        self.referenced = set()
+        self.updated = {}
+        self.deleted = set()
+
+    def reference(self, key):
+        """Record that a policy still references the path, even if it is not compared in this run."""
+        self.referenced.add(key)
+
+    def policy_entry(self, saved):
+        if isinstance(saved, str):
+            saved = {'policyId': saved}
+        return self.policies.get(saved['policyId']) or {
+            'policyId': saved['policyId'],
+            'policyDisplayName': saved.get('policyDisplayName'),
+            'policyState': saved.get('policyState'),
+            'policyLastModifiedDateTime': saved.get('policyLastModifiedDateTime'),
+        }
+
+    def emit(self, member_events, entries, key, member_of, state, members, added_state="Added to Excluded Group", removed_state="Removed from Excluded Group"):
+        
+        self.reference(key)
+        
+        ckpt_key = self.prefix + key
+        previous = self.helper.get_check_point(ckpt_key)
+        
+        if previous is None and not members:
+            return 0
+        
+        self.known.add(key)
+        
+        fingerprint = member_set_fingerprint(members)
+        policy_ids = [g['policyId'] for g in entries]
+        saved_entries = [{f: g[f] for f in ('policyId', 'policyDisplayName', 'policyState', 'policyLastModifiedDateTime')} for g in entries]
+        
+        if previous is None:
+            previous_entries = []
+            unchanged = False
+        else:
+            previous_entries = [self.policy_entry(p) for p in previous.get('policies', [])]
+            unchanged = previous.get('fingerprint') == fingerprint
+        
+        previous_policies = [p['policyId'] for p in previous_entries]
+        previous_members = None
+        written = 0
+        
+        for g in entries:
+            if g['policyId'] not in previous_policies:
+                member_ids = unpack_guids(members)
+                member_events.write(g, member_of, state, member_ids)
+                written += len(member_ids)
+            elif not unchanged:
+                if previous_members is None:
+                    previous_members = decode_member_set(previous.get('members', {}))
+                added = unpack_guids(members - previous_members)
+                removed = unpack_guids(previous_members - members)
+                member_events.write(g, member_of, added_state, added)
+                member_events.write(g, member_of, removed_state, removed)
+                written += len(added) + len(removed)
+        
+        for p in previous_entries:
+            if p['policyId'] not in policy_ids:
+                if previous_members is None:
+                    previous_members = decode_member_set(previous.get('members', {}))
+                removed = unpack_guids(previous_members)
+                member_events.write(p, member_of, removed_state, removed)
+                written += len(removed)
+        
+        member_events.end()
+        
+        if (not unchanged or previous.get('policies') != saved_entries or previous.get('memberOf') != member_of
+                or previous.get('removedState') != removed_state):
+            self.updated[ckpt_key] = {'fingerprint': fingerprint, 'policies': saved_entries, 'members': encode_member_set(members),
+                                      'memberOf': member_of, 'removedState': removed_state}
+        
+        return written
+
+    @staticmethod
+    def kind(key):
+        if key.startswith('role_'):
+            return 'role'
+        if key.startswith('direct_'):
+            return 'direct'
+        return 'group'
+
+    def remove_unreferenced(self, member_events, kinds=('group', 'role', 'direct')):
+        """Write every member of the saved paths no longer referenced by any policy as removed, and forget them.
+
+        Only paths of the given kinds were compared by this run. Paths of other kinds, left by a run in another
+        collection mode, are forgotten without writing anything.
+        """
+        
+        written = 0
+        unreferenced = sorted(self.known - self.referenced)
+        
+        for key in unreferenced:
+            ckpt_key = self.prefix + key
+            previous = self.helper.get_check_point(ckpt_key) if self.kind(key) in kinds else None
+            if previous is not None and 'memberOf' in previous:
+                removed = unpack_guids(decode_member_set(previous.get('members', {})))
+                for p in previous.get('policies', []):
+                    member_events.write(self.policy_entry(p), previous['memberOf'], previous['removedState'], removed)
+                    written += len(removed)
+                member_events.end()
+            self.known.discard(key)
+            self.deleted.add(ckpt_key)
+        
+        if unreferenced:
+            self.helper.log_info(f'{len(unreferenced)} exclusion paths are no longer referenced by any policy. {written} removals ingested.')
+        
+        return written
+
+    def save(self):
+        
+        keys = list(self.updated)
+        for i in range(0, len(keys), SNAPSHOT_SAVE_BATCH_SIZE):
+            batch_save_check_points(self.helper, {k: self.updated[k] for k in keys[i:i + SNAPSHOT_SAVE_BATCH_SIZE]})
+        
+        for ckpt_key in self.deleted:
+            self.helper.delete_check_point(ckpt_key)
+        
+        self.helper.save_check_point(self.index_ckpt_key, {'keys': sorted(self.known)})
+        
+        self.helper.log_info(f'Saved {len(keys)} updated and deleted {len(self.deleted)} membership snapshots.')
+        self.updated = {}
+        self.deleted = set()
+
+def member_event_prefix(g, member_of, state):
+    """Return the JSON text of a per-user event up to the excludedUserId value.
+
+    The first six keys are the same for every member of a group under one policy, so they are encoded once
+    and each event only appends its encoded member id and the closing brace. The result is the same text as
+    json.dumps of the full 7-key dict with compact separators.
+    """
+    
+    xu = {}
+    xu['policyId'] = g['policyId']
+    xu['policyDisplayName'] = g['policyDisplayName']
+    xu['policyState'] = g['policyState']
+    xu['policyLastModifiedDateTime'] = g['policyLastModifiedDateTime']
+    xu['excludedUserMemberOf'] = member_of
+    xu['excludedUserState'] = state
+    
+    return json.dumps(xu, separators=(',', ':'))[:-1] + ',"excludedUserId":'
+
+class DirectoryObjectResolver(object):
+    """Resolve user and group ids to their names through directoryObjects/getByIds, with a persisted TTL cache.
+
+    Ids missing from the cache, or cached more than ttl seconds ago, are resolved GET_BY_IDS_BATCH_SIZE at a
+    time. Each cache entry is [expires_at, displayName, userPrincipalName, accountEnabled]; objects Graph did
+    not return (e.g. deleted users) are cached with empty values so they are not asked for again until they
+    expire. The cache is kept in the checkpoint store in one checkpoint per DIRECTORY_OBJECT_CACHE_SHARDS
+    character; shards are loaded when first needed and save() writes the changed ones back.
+    """
+
+    def __init__(self, helper, client, ttl=DIRECTORY_OBJECT_CACHE_TTL):
+        self.helper = helper
+        self.client = client
+        self.ttl = ttl
+        self.prefix = f'{helper.get_input_stanza_names()}_directory_objects_'
+        self.shards = {}
+        self.dirty = set()
+        self.resolved = 0
+
+    def shard(self, object_id):
+        name = object_id[:1].lower()
+        if name not in DIRECTORY_OBJECT_CACHE_SHARDS:
+            name = 'other'
+        if name not in self.shards:
+            shard = self.helper.get_check_point(self.prefix + name) or {}
+            # Ids not seen again before they expired are dropped, so the cache does not keep every id ever seen.
+            now = int(time.time())
+            live = {object_id: entry for object_id, entry in shard.items() if entry[0] > now}
+            if len(live) < len(shard):
+                self.dirty.add(name)
+            self.shards[name] = live
+        return name, self.shards[name]
+
+    def get(self, object_id):
+        return self.shard(object_id)[1].get(object_id)
+
+    def resolve(self, object_ids):
+        
+        now = int(time.time())
+        missing = []
+        for object_id in dict.fromkeys(object_ids):
+            entry = self.get(object_id)
+            if entry is None or entry[0] <= now:
+                missing.append(object_id)
+        
+        for i in range(0, len(missing), GET_BY_IDS_BATCH_SIZE):
+            self.fetch(missing[i:i + GET_BY_IDS_BATCH_SIZE], now)
+
+    def fetch(self, object_ids, now):
+        
+        response = self.client.post('directoryObjects/getByIds', json={'ids': object_ids, 'types': ['user', 'group']})
+        
+        if response.status_code != 200:
+            self.helper.log_error(f'Error occurred. Status={str(response.status_code)} {response.text}. {len(object_ids)} directory objects could not be resolved.')
+            return
+        
+        found = {o['id']: o for o in response.json().get('value', [])}
+        expires_at = now + self.ttl
+        
+        for object_id in object_ids:
+            o = found.get(object_id, {})
+            name, shard = self.shard(object_id)
+            shard[object_id] = [expires_at, o.get('displayName'), o.get('userPrincipalName'), o.get('accountEnabled')]
+            self.dirty.add(name)
+        
+        self.resolved += len(object_ids)
+
+    def user_fields(self, object_id):
+        """Return the JSON text of the user fields added to a per-user event, starting with a comma."""
+        
+        entry = self.get(object_id) or [None, None, None, None]
+        
+        return (',"excludedUserPrincipalName":' + json.dumps(entry[2]) +
+                ',"excludedUserDisplayName":' + json.dumps(entry[1]) +
+                ',"excludedUserAccountEnabled":' + json.dumps(entry[3]))
+
+    def group_name(self, object_id):
+        entry = self.get(object_id)
+        return entry[1] if entry else None
+
+    def save(self):
+        
+        if self.dirty:
+            batch_save_check_points(self.helper, {self.prefix + name: self.shards[name] for name in self.dirty})
+        
+        self.helper.log_info(f'Resolved {self.resolved} directory objects through Microsoft Graph. Updated {len(self.dirty)} cache shards.')
+        self.dirty = set()
+
+def resolve_member_objects(resolver, member_of, state, member_ids):
+    
+    # Directory roles are excluded by template id, which getByIds does not know.
+    if state in GROUP_STATES:
+        resolver.resolve([member_of] + list(member_ids))
+    else:
+        resolver.resolve(member_ids)
+
+class PerUserMemberEventWriter(object):
+    """Write one event per exempted user, policy and exemption path (the default event schema).
+
+    With a DirectoryObjectResolver, the user's principal name, display name and accountEnabled and the
+    excluded group's display name are added after excludedUserId. With a run_id, collectionRunId comes last.
+    """
+
+    def __init__(self, ew, serializer, resolver=None, run_id=None):
+        self.ew = ew
+        self.serializer = serializer
+        self.resolver = resolver
+        self.end_text = '}' if run_id is None else ',"collectionRunId":' + encode_json_string(run_id) + '}'
+
+    def write(self, g, member_of, state, member_ids):
+        if not member_ids:
+            return
+        
+        prefix = member_event_prefix(g, member_of, state)
+        
+        if self.resolver is None:
+            for member_id in member_ids:
+                data_event = prefix + encode_json_string(member_id) + self.end_text
+                self.ew.write_serialized_event(self.serializer.serialize(data_event))
+            return
+        
+        resolve_member_objects(self.resolver, member_of, state, member_ids)
+        suffix = ',"excludedUserMemberOfDisplayName":' + json.dumps(self.resolver.group_name(member_of)) + self.end_text
+        for member_id in member_ids:
+            data_event = prefix + encode_json_string(member_id) + self.resolver.user_fields(member_id) + suffix
+            self.ew.write_serialized_event(self.serializer.serialize(data_event))
+
+    def resolve(self, member_ids):
+        """Resolve member_ids in bulk ahead of writes that each hold only a few of them."""
+        if self.resolver is not None:
+            self.resolver.resolve(member_ids)
+
+    def end(self):
+        pass
+
+    def has_pending(self):
+        return False
+
+class AggregatedMemberEventWriter(object):
+    """Write one event per policy, exemption path and state, listing the member ids in excludedUserIds.
+
+    Ids are collected across pages and written in chunks of at most max_members ids and max_bytes of JSON,
+    numbered by excludedUserChunk, so event size stays bounded for large groups. end() writes the remaining
+    partial chunks. With a DirectoryObjectResolver, the excluded group's display name and the principal names of
+    the members, in the order of excludedUserIds, are added. With a run_id, collectionRunId comes last.
+    """
+
+    def __init__(self, ew, serializer, max_members=AGGREGATED_EVENT_MAX_MEMBERS, resolver=None, run_id=None, max_bytes=EVENT_MAX_BYTES):
+        self.ew = ew
+        self.serializer = serializer
+        self.max_members = max_members
+        self.max_bytes = max_bytes
+        self.resolver = resolver
+        self.run_id = run_id
+        self.pending = {}
+
+    def write(self, g, member_of, state, member_ids):
+        if self.resolver is not None and member_ids:
+            resolve_member_objects(self.resolver, member_of, state, member_ids)
+        
+        key = (g['policyId'], member_of, state)
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = {'g': g, 'ids': [], 'chunk': 0, 'bytes': 0}
+            # The margin covers the digits of excludedUserChunk and excludedUserCount.
+            entry['base'] = len(json.dumps(self.event(entry, member_of, state, []), separators=(',', ':'))) + 32
+            self.pending[key] = entry
+        
+        ids = entry['ids']
+        for member_id in member_ids:
+            size = self.member_size(member_id)
+            if ids and entry['base'] + entry['bytes'] + size > self.max_bytes:
+                self.write_chunk(entry, member_of, state, ids)
+                ids = entry['ids']
+            ids.append(member_id)
+            entry['bytes'] += size
+            if len(ids) >= self.max_members:
+                self.write_chunk(entry, member_of, state, ids)
+                ids = entry['ids']
+
+    def resolve(self, member_ids):
+        """Resolve member_ids in bulk ahead of writes that each hold only a few of them."""
+        if self.resolver is not None:
+            self.resolver.resolve(member_ids)
+
+    def member_size(self, member_id):
+        """Return the bytes one member adds to an event: its id and, when enriched, its principal name."""
+        # json.dumps escapes non-ASCII characters, so string lengths are byte counts.
+        size = len(encode_json_string(member_id)) + 1
+        if self.resolver is not None:
+            size += len(json.dumps(self.principal_name(member_id))) + 1
+        return size
+
+    def principal_name(self, member_id):
+        return (self.resolver.get(member_id) or [None] * 4)[2]
+
+    def event(self, entry, member_of, state, member_ids):
+        g = entry['g']
+        
+        xg = {}
+        xg['policyId'] = g['policyId']
+        xg['policyDisplayName'] = g['policyDisplayName']
+        xg['policyState'] = g['policyState']
+        xg['policyLastModifiedDateTime'] = g['policyLastModifiedDateTime']
+        xg['excludedUserMemberOf'] = member_of
+        xg['excludedUserState'] = state
+        xg['excludedUserChunk'] = entry['chunk']
+        xg['excludedUserCount'] = len(member_ids)
+        xg['excludedUserIds'] = member_ids
+        
+        if self.resolver is not None:
+            xg['excludedUserMemberOfDisplayName'] = self.resolver.group_name(member_of)
+            xg['excludedUserPrincipalNames'] = [self.principal_name(m) for m in member_ids]
+        
+        if self.run_id is not None:
+            xg['collectionRunId'] = self.run_id
+        
+        return xg
+
+    def write_chunk(self, entry, member_of, state, member_ids):
+        entry['chunk'] += 1
+        entry['ids'] = []
+        entry['bytes'] = 0
+        
+        data_event = json.dumps(self.event(entry, member_of, state, member_ids), separators=(',', ':'))
+        self.ew.write_serialized_event(self.serializer.serialize(data_event))
+
+    def end(self):
+        for (policy_id, member_of, state), entry in self.pending.items():
+            if entry['ids']:
+                self.write_chunk(entry, member_of, state, entry['ids'])
+        self.pending = {}
+
+    def has_pending(self):
+        """Tell whether member ids are held for a chunk that is not written yet."""
+        return any(entry['ids'] for entry in self.pending.values())
+
+class ExemptUserSummary(object):
+    """Collect every exemption path per user to write one summary event per user at the end of a run.
+
+    Users are keyed by their packed id (see pack_guid) and each (policy, memberOf, state) path is stored once and
+    referenced by index, so a user exempted by many policies and groups costs a dict entry and a short list of
+    ints. Removals seen in delta mode are not exemptions and are not recorded.
+    """
+
+    def __init__(self):
+        self.paths = []
+        self.path_index = {}
+        self.user_paths = {}
+
+    def add(self, g, member_of, state, member_ids):
+        if state == "Removed from Excluded Group" or not member_ids:
+            return
+        
+        key = (g['policyId'], member_of, state)
+        path = self.path_index.get(key)
+        if path is None:
+            path = len(self.paths)
+            self.path_index[key] = path
+            self.paths.append((g['policyId'], g['policyDisplayName'], member_of, state))
+        
+        user_paths = self.user_paths
+        for member_id in member_ids:
+            user = pack_guid(member_id)
+            paths = user_paths.get(user)
+            if paths is None:
+                user_paths[user] = [path]
+            elif path not in paths:
+                paths.append(path)
+
+    def write(self, ew, serializer, max_bytes=EVENT_MAX_BYTES):
+        """Write one event per user, split into several events with the same counts and an exemptionChunk
+        number when the exemptions of a user do not fit in max_bytes."""
+        for user, paths in self.user_paths.items():
+            exemptions = []
+            policy_ids = []
+            for path in paths:
+                policy_id, policy_name, member_of, state = self.paths[path]
+                
+                xp = {}
+                xp['policyId'] = policy_id
+                xp['policyDisplayName'] = policy_name
+                xp['excludedUserMemberOf'] = member_of
+                xp['excludedUserState'] = state
+                exemptions.append(json.dumps(xp, separators=(',', ':')))
+                
+                if policy_id not in policy_ids:
+                    policy_ids.append(policy_id)
+            
+            xs = {}
+            xs['excludedUserId'] = unpack_guid(user)
+            xs['policyCount'] = len(policy_ids)
+            xs['policyIds'] = policy_ids
+            xs['exemptionCount'] = len(exemptions)
+            
+            # json.dumps escapes non-ASCII characters, so string lengths are byte counts. The margin covers the
+            # exemptionChunk and exemptions keys around the items.
+            prefix = json.dumps(xs, separators=(',', ':'))[:-1]
+            base = len(prefix) + 64
+            chunks = [[]]
+            size = base
+            for xp in exemptions:
+                if chunks[-1] and size + len(xp) + 1 > max_bytes:
+                    chunks.append([])
+                    size = base
+                chunks[-1].append(xp)
+                size += len(xp) + 1
+            
+            for n, chunk in enumerate(chunks):
+                if len(chunks) > 1:
+                    data_event = f'{prefix},"exemptionChunk":{n},"exemptions":[{",".join(chunk)}]}}'
+                else:
+                    data_event = f'{prefix},"exemptions":[{",".join(chunk)}]}}'
+                ew.write_serialized_event(serializer.serialize(data_event))
+        
+        return len(self.user_paths)
+
+class SummarizingMemberEventWriter(object):
+    """Member event writer that also records what it writes in an ExemptUserSummary."""
+
+    def __init__(self, member_events, summary):
+        self.member_events = member_events
+        self.summary = summary
+
+    def write(self, g, member_of, state, member_ids):
+        self.summary.add(g, member_of, state, member_ids)
+        self.member_events.write(g, member_of, state, member_ids)
+
+    def resolve(self, member_ids):
+        self.member_events.resolve(member_ids)
+
+    def end(self):
+        self.member_events.end()
+
+    def has_pending(self):
+        return self.member_events.has_pending()
+
+def new_member_event_writer(helper, ew, meta_source, resolver=None, run_id=None):
+    
+    if helper.get_arg('event_schema') == 'aggregated':
+        serializer = ew.new_serializer(source=meta_source, sourcetype=AGGREGATED_SOURCETYPE, index=helper.get_output_index())
+        return AggregatedMemberEventWriter(ew, serializer, resolver=resolver, run_id=run_id)
+    
+    serializer = ew.new_serializer(source=meta_source, sourcetype=helper.get_sourcetype(), index=helper.get_output_index())
+    return PerUserMemberEventWriter(ew, serializer, resolver, run_id)
+
+def get_role_members(helper, client, role_template_id):
+    """Return the member ids of the directory role activated from role_template_id, or None if the request failed.
+
+    A role that was never activated in the tenant has no directoryRole object (404) and so no members.
+    """
+    
+    response = client.get(f"directoryRoles(roleTemplateId='{role_template_id}')/members?$select=id")
+    
+    if response.status_code == 404:
+        helper.log_info(f'Directory role {role_template_id} is not activated in the tenant. It has no members.')
+        return []
+    
+    members = []
+    
+    while True:
+        
+        if response.status_code != 200:
+            helper.log_error(f'Error occurred. Status={str(response.status_code)} {response.text}. Members of directory role {role_template_id} could not be retrieved.')
+            return None
+        
+        page = response.json()
+        members.extend(m['id'] for m in page.get('value', []))
+        
+        if '@odata.nextLink' not in page:
+            return members
+        
+        response = client.get(page['@odata.nextLink'])
+
+def get_role_member_index(helper, client, role_template_ids, max_concurrency, deadline=None):
+    """Build the role template id -> member ids index of a run, reading each distinct role once, in parallel.
+
+    Roles whose request failed are indexed as None. Roles not read before the deadline are left out.
+    """
+    
+    role_template_ids = list(role_template_ids)
+    not_read = object()
+    
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        members = executor.map(lambda rid: not_read if deadline_passed(deadline) else get_role_members(helper, client, rid), role_template_ids)
+        return {rid: m for rid, m in zip(role_template_ids, members) if m is not not_read}
+
+def ingest_role_members(helper, member_events, client, roles, max_concurrency, snapshots=None, progress=None, deadline=None):
+    """Write the members of the directory roles excluded from CAP.
+
+    Policies excluding the same role share one index entry, so a role costs the same number of calls however
+    many policies exclude it. Graph has no delta query for role members, so in the delta and snapshot modes
+    members are compared with a MembershipSnapshots checkpoint instead. Returns a (roles_left, roles_failed)
+    tuple: the number of roles left unwritten because the deadline passed, and of roles whose members could not
+    be retrieved.
+    """
+    
+    roles_by_id = {}
+    for r in roles:
+        roles_by_id.setdefault(r['excludedRoles'], []).append(r)
+    
+    helper.log_info(f'{len(roles)} policy exclusions reference {len(roles_by_id)} distinct directory roles.')
+    
+    if progress is not None:
+        role_ids = [rid for rid in roles_by_id if not progress.is_completed(f'role_{rid}')]
+        if len(role_ids) < len(roles_by_id):
+            helper.log_info(f'{len(roles_by_id) - len(role_ids)} directory roles were already written by run {progress.generation}. Skipping them.')
+        roles_by_id = {rid: roles_by_id[rid] for rid in role_ids}
+    
+    if snapshots is not None:
+        for rid in roles_by_id:
+            snapshots.reference(f'role_{rid}')
+    
+    role_members = get_role_member_index(helper, client, roles_by_id, max_concurrency, deadline)
+    roles_left = 0
+    
+    if snapshots is None:
+        member_events.resolve([m for members in role_members.values() if members for m in members])
+    roles_failed = 0
+    
+    for rid, entries in roles_by_id.items():
+        
+        if rid not in role_members:
+            roles_left += 1
+            continue
+        
+        members = role_members[rid]
+        
+        if members is None:
+            helper.log_warning(f'Members of CAP-exclusion directory role {rid} could not be retrieved. Skipping role.')
+            roles_failed += 1
+            continue
+        
+        if snapshots is not None:
+            written = snapshots.emit(member_events, entries, f'role_{rid}', rid, "Excluded from Policy via Directory Role", {pack_guid(m) for m in members},
+                                     "Added to Excluded Directory Role", "Removed from Excluded Directory Role")
+            helper.log_info(f'CAP-exclusion directory role {rid} has {len(members)} members. {written} membership changes ingested.')
+            continue
+        
+        for r in entries:
+            member_events.write(r, rid, "Excluded from Policy via Directory Role", members)
+        
+        member_events.end()
+        
+        if progress is not None:
+            progress.step_written(f'role_{rid}')
+        
+        helper.log_info(f'All {len(members)} members of CAP-exclusion directory role {rid} ingested for {len(entries)} policies.')
+    
+    if roles_left:
+        helper.log_warning(f'Run time budget used up. {roles_left} of {len(roles_by_id)} CAP-exclusion directory roles are left for the next run.')
+    
+    return roles_left, roles_failed
+
+class CollectionProgress(object):
+    """Progress of a full collection run, saved so a run that was stopped part-way resumes where it stopped.
+
+    The progress holds a run generation id, the exclusion steps and groups already written, and the
+    @odata.nextLink following the last written page of each group in progress. It is saved with
+    batch_save_check_points at most every RUN_PROGRESS_SAVE_SECONDS, always after flushing the event writer,
+    so saved progress never gets ahead of the events. A run that finds recent unfinished progress continues
+    its generation: completed steps and groups are skipped and groups in progress resume from their link.
+    finish() removes the progress once the run is complete.
+    """
+
+    def __init__(self, helper, ew):
+        self.helper = helper
+        self.ew = ew
+        stanza = helper.get_input_stanza_names()
+        self.ckpt_key = f'{stanza}_run_progress'
+        self.links_ckpt_key = f'{stanza}_run_next_links'
+        
+        saved = helper.get_check_point(self.ckpt_key)
+        if saved and time.time() - saved.get('updated', 0) < RUN_PROGRESS_MAX_AGE:
+            self.generation = saved['generation']
+            self.completed = set(saved.get('completed', []))
+            self.next_links = helper.get_check_point(self.links_ckpt_key) or {}
+            self.resumed = True
+            helper.log_info(f'Resuming collection run {self.generation}: {len(self.completed)} steps and groups already written, {len(self.next_links)} groups in progress.')
+        else:
+            self.generation = f'{int(time.time())}-{os.urandom(4).hex()}'
+            self.completed = set()
+            self.next_links = {}
+            self.resumed = False
+        
+        self.last_save = time.time()
+
+    def is_completed(self, name):
+        return name in self.completed
+
+    def page_written(self, group_id, next_link, pending=False):
+        """Record that a page of group_id was written. next_link is the link of the page that follows it.
+
+        With pending, the member event writer still holds members of the group that are not written yet, so
+        the saved link stays at the last page from which every member was written.
+        """
+        if pending:
+            pass
+        elif next_link:
+            self.next_links[group_id] = next_link
+        else:
+            # The last page: no link left to resume from until the group is recorded as written.
+            self.next_links.pop(group_id, None)
+        self.save_if_due()
+
+    def step_written(self, name):
+        self.next_links.pop(name, None)
+        self.completed.add(name)
+        self.save_if_due()
+
+    def save_if_due(self):
+        if time.time() - self.last_save >= RUN_PROGRESS_SAVE_SECONDS:
+            self.save()
+
+    def save(self):
+        self.ew.flush()
+        batch_save_check_points(self.helper, {
+            self.ckpt_key: {'generation': self.generation, 'updated': int(time.time()), 'completed': sorted(self.completed)},
+            self.links_ckpt_key: self.next_links,
+        })
+        self.last_save = time.time()
+
+    def finish(self):
+        self.helper.delete_check_point(self.ckpt_key)
+        self.helper.delete_check_point(self.links_ckpt_key)
+
+def load_group_sizes(helper):
+    
+    return helper.get_check_point(f'{helper.get_input_stanza_names()}_group_sizes') or {}
+
+def save_group_sizes(helper, group_sizes):
+    
+    helper.save_check_point(f'{helper.get_input_stanza_names()}_group_sizes', group_sizes)
+
+def order_groups_by_size(group_ids, group_sizes):
+    """Order groups from the smallest to the largest member count seen by previous runs, unknown groups first.
+
+    With a time budget, this completes as many groups as possible before the deadline and leaves the largest
+    ones, which are the most likely not to fit, for last.
+    """
+    
+    return sorted(group_ids, key=lambda gid: group_sizes.get(gid, 0))
+
+def get_policies_by_excluded_group(groups):
+    """Index the (policy, group) entries of get_excluded_groups_from_cap by group id, in order of first appearance."""
+    
+    groups_by_id = {}
+    
+    for g in groups:
+        groups_by_id.setdefault(g['excludedGroups'], []).append(g)
+    
+    return groups_by_id
+
+def ingest_group_members(helper, member_events, client, groups, max_concurrency, progress=None, deadline=None):
+    """Full collection mode: write every member of every excluded group.
+
+    Returns a (groups_left, groups_failed) tuple: the number of groups left unfinished because the deadline
+    passed, and the number of groups that could not be read completely for another reason.
+    """
+    
+    # A group excluded from several policies is fetched once and its members are written for every policy.
+    groups_by_id = get_policies_by_excluded_group(groups)
+    group_ids = list(groups_by_id)
+    start_links = None
+    group_sizes = None
+    
+    if deadline is not None:
+        group_sizes = load_group_sizes(helper)
+        group_ids = order_groups_by_size(group_ids, group_sizes)
+    
+    if progress is not None:
+        group_ids = [gid for gid in group_ids if not progress.is_completed(gid)]
+        start_links = {gid: link for gid, link in progress.next_links.items() if gid in groups_by_id}
+        if len(group_ids) < len(groups_by_id):
+            helper.log_info(f'{len(groups_by_id) - len(group_ids)} groups were already written by run {progress.generation}. Skipping them.')
+    
+    transitive = bool(helper.get_arg('expand_nested_groups'))
+    page_size = get_page_size(helper)
+    
+    helper.log_info(f'{len(groups)} policy exclusions reference {len(group_ids)} distinct groups. expand_nested_groups={transitive} page_size={page_size}')
+    
+    # Memberships are fetched in parallel, GRAPH_BATCH_SIZE groups per $batch call, and streamed back page by
+    # page in group order, so events are written one at a time, in a deterministic order, as pages arrive.
+    stream = OrderedGroupPageStream(helper, client, group_ids, max_concurrency, transitive, page_size, start_links, deadline)
+    groups_left = 0
+    groups_failed = 0
+    
+    for gid, pages in stream:
+        
+        helper.log_info(f'Ingesting users/members of CAP-exclusion group {gid} for {len(groups_by_id[gid])} policies...')
+        
+        member_count = 0
+        
+        for page in pages:
+            member_count += len(page)
+            member_ids = [m['id'] for m in page]
+            for g in groups_by_id[gid]:
+                member_events.write(g, gid, "Excluded from Policy via Group", member_ids)
+            if progress is not None:
+                progress.page_written(gid, stream.next_link(gid), member_events.has_pending())
+        
+        member_events.end()
+        
+        if gid in stream.incomplete_groups:
+            # A group that failed or ran out of time part-way is left unfinished, so a resumed run reads it again.
+            if deadline_passed(deadline):
+                groups_left += 1
+            else:
+                groups_failed += 1
+            continue
+        
+        if progress is not None:
+            progress.step_written(gid)
+        
+        if group_sizes is not None and (start_links is None or gid not in start_links):
+            group_sizes[gid] = member_count
+        
+        helper.log_info(f'All {member_count} members of CAP-exclusion group {gid} ingested.')
+    
+    if group_sizes is not None:
+        save_group_sizes(helper, {gid: size for gid, size in group_sizes.items() if gid in groups_by_id})
+    
+    if groups_left:
+        helper.log_warning(f'Run time budget used up. {groups_left} of {len(groups_by_id)} CAP-exclusion groups are left for the next run.')
+    
+    return groups_left, groups_failed
+
+def ingest_group_member_snapshots(helper, member_events, client, groups, max_concurrency, snapshots, deadline=None):
+    """Snapshot collection mode: read every member like ingest_group_members, emit only the differences.
+    
+    A group is compared only once all of its pages are read. Groups that could not be read completely, or not
+    before the deadline, are skipped and keep their previous snapshot, so a failed request is never reported as
+    removed members and the next run compares them again.
+    """
+    
+    groups_by_id = get_policies_by_excluded_group(groups)
+    group_ids = list(groups_by_id)
+    group_sizes = None
+    
+    if deadline is not None:
+        group_sizes = load_group_sizes(helper)
+        group_ids = order_groups_by_size(group_ids, group_sizes)
+    
+    transitive = bool(helper.get_arg('expand_nested_groups'))
+    page_size = get_page_size(helper)
+    
+    helper.log_info(f'{len(groups)} policy exclusions reference {len(group_ids)} distinct groups. expand_nested_groups={transitive} page_size={page_size}')
+    
+    for gid in group_ids:
+        snapshots.reference(gid)
+    
+    stream = OrderedGroupPageStream(helper, client, group_ids, max_concurrency, transitive, page_size, deadline=deadline)
+    groups_left = 0
+    
+    for gid, pages in stream:
+        
+        members = set()
+        for page in pages:
+            members.update(pack_guid(m['id']) for m in page)
+        
+        if gid in stream.incomplete_groups:
+            if deadline_passed(deadline):
+                groups_left += 1
+            else:
+                helper.log_warning(f'Members of CAP-exclusion group {gid} could not be read completely. Keeping its previous snapshot.')
+            continue
+        
+        written = snapshots.emit(member_events, groups_by_id[gid], gid, gid, "Excluded from Policy via Group", members)
+        
+        if group_sizes is not None:
+            group_sizes[gid] = len(members)
+        
+        helper.log_info(f'CAP-exclusion group {gid} has {len(members)} members. {written} membership changes ingested.')
+    
+    if group_sizes is not None:
+        save_group_sizes(helper, {gid: size for gid, size in group_sizes.items() if gid in groups_by_id})
+    
+    if groups_left:
+        helper.log_warning(f'Run time budget used up. {groups_left} of {len(groups_by_id)} CAP-exclusion groups keep their previous snapshot until the next run.')
+
+def get_delta_chunks(saved_chunks, groups_by_id):
+    """Assign the excluded groups of a run to groups/delta chunks, keeping the chunks of the previous run.
+
+    A saved chunk is {'groups': {group id: ids of the policies its members were written for}, 'link': its
+    @odata.deltaLink}. Groups keep the chunk whose link already tracks them; groups no longer excluded are
+    dropped from it and their changes are ignored. Groups not tracked yet go to new chunks of up to
+    DELTA_GROUP_FILTER_SIZE groups without a link, so adding or removing a group never moves another one.
+    """
+    
+    chunks = []
+    tracked = set()
+    
+    for saved in saved_chunks:
+        chunk_groups = {gid: policy_ids for gid, policy_ids in saved['groups'].items() if gid in groups_by_id}
+        if chunk_groups:
+            chunks.append({'groups': chunk_groups, 'link': saved['link']})
+            tracked.update(chunk_groups)
+    
+    new_ids = [gid for gid in groups_by_id if gid not in tracked]
+    for i in range(0, len(new_ids), DELTA_GROUP_FILTER_SIZE):
+        chunks.append({'groups': {gid: [] for gid in new_ids[i:i + DELTA_GROUP_FILTER_SIZE]}, 'link': None})
+    
+    return chunks
+
+def ingest_group_member_changes(helper, member_events, client, groups, max_concurrency, deadline=None):
+    """Delta collection mode: emit only membership changes since the previous run.
+
+    Excluded groups are queried DELTA_GROUP_FILTER_SIZE at a time (see get_delta_chunks) and each chunk's
+    @odata.deltaLink is kept in the checkpoint store with the policies every group was written for. A new
+    group starts a baseline of its own chunk. A policy newly excluding a group already tracked gets the current
+    members of that group, read in full, while the other policies only get its changes. Chunks not queried
+    before the deadline keep their saved link and are queried by the next run.
+    """
+    
+    if helper.get_arg('expand_nested_groups'):
+        helper.log_warning('expand_nested_groups is not supported by the delta collection mode. Nested groups are reported as members.')
+    
+    ckpt_key = f'{helper.get_input_stanza_names()}_delta_links'
+    saved_chunks = (helper.get_check_point(ckpt_key) or {}).get('chunks', [])
+    
+    groups_by_id = get_policies_by_excluded_group(groups)
+    chunks = get_delta_chunks(saved_chunks, groups_by_id)
+    
+    new_chunks = []
+    # Group id -> (chunk entry, policy entries) of the groups to read in full for policies that newly exclude them.
+    full_reads = {}
+    
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        
+        def get_chunk_changes(chunk):
+            if deadline_passed(deadline):
+                return 'deadline', None, False
+            return get_group_member_changes(helper, client, list(chunk['groups']), chunk['link'])
+        
+        all_chunk_changes = executor.map(get_chunk_changes, chunks)
+        
+        for chunk, (changes, delta_link, is_baseline) in zip(chunks, all_chunk_changes):
+            
+            if changes == 'deadline':
+                helper.log_warning(f'Run time budget used up. Membership changes of {len(chunk["groups"])} CAP-exclusion groups are left for the next run.')
+                if chunk['link']:
+                    new_chunks.append(chunk)
+                continue
+            
+            if changes is None:
+                helper.log_warning(f'Membership changes of {len(chunk["groups"])} CAP-exclusion groups could not be retrieved. Skipping groups.')
+                if chunk['link']:
+                    new_chunks.append(chunk)
+                continue
+            
+            new_chunk = {'groups': {}, 'link': delta_link}
+            
+            for gid, written_policies in chunk['groups'].items():
+                
+                added = unpack_guids(changes[gid]['added'])
+                removed = unpack_guids(changes[gid]['removed'])
+                
+                helper.log_info(f'CAP-exclusion group {gid} baseline={is_baseline} added={len(added)} removed={len(removed)}. Now ingesting users/members...')
+                
+                new_entries = []
+                for g in groups_by_id[gid]:
+                    if is_baseline:
+                        member_events.write(g, gid, "Excluded from Policy via Group", added)
+                    elif g['policyId'] in written_policies:
+                        member_events.write(g, gid, "Added to Excluded Group", added)
+                        member_events.write(g, gid, "Removed from Excluded Group", removed)
+                    else:
+                        new_entries.append(g)
+                
+                member_events.end()
+                
+                new_chunk['groups'][gid] = [g['policyId'] for g in groups_by_id[gid] if g not in new_entries]
+                if new_entries:
+                    full_reads[gid] = (new_chunk, new_entries)
+            
+            if delta_link:
+                new_chunks.append(new_chunk)
+    
+    if full_reads:
+        
+        helper.log_info(f'{len(full_reads)} CAP-exclusion groups are newly excluded from a policy. Reading their members for these policies.')
+        
+        stream = OrderedGroupPageStream(helper, client, list(full_reads), max_concurrency, page_size=get_page_size(helper), deadline=deadline)
+        
+        for gid, pages in stream:
+            
+            new_chunk, new_entries = full_reads[gid]
+            
+            for page in pages:
+                member_ids = [m['id'] for m in page]
+                for g in new_entries:
+                    member_events.write(g, gid, "Excluded from Policy via Group", member_ids)
+            
+            member_events.end()
+            
+            if gid in stream.incomplete_groups:
+                helper.log_warning(f'Members of CAP-exclusion group {gid} could not be read completely. The policies newly excluding it are read again by the next run.')
+                continue
+            
+            new_chunk['groups'][gid].extend(g['policyId'] for g in new_entries)
+    
+    # Saved only once every chunk is written, so an interrupted run replays its changes instead of losing them.
+    helper.save_check_point(ckpt_key, {'chunks': new_chunks})
+
+def escape_xml_text(text):
+    """Escape text exactly like ElementTree does for element text serialized with ET.tostring (us-ascii)."""
+    
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    if not text.isascii():
+        text = text.encode('ascii', 'xmlcharrefreplace').decode('ascii')
+    
+    return text
+
+class XmlEventSerializer(object):
+    """Serialize <event> elements of the modular input XML stream from a precomputed template.
+
+    source, sourcetype, index and host are the same for every event a run writes to one sourcetype, so the
+    constant part of the element is built once and only the <data> payload is escaped per event. The output is
+    byte-for-byte what splunklib's Event.write_to produces for the same values (unbroken and done events
+    without a time).
+    """
+
+    def __init__(self, source=None, sourcetype=None, index=None, host=None, stanza=None):
+        prefix = ['<event']
+        if stanza is not None:
+            prefix.append(' stanza="%s"' % escape_xml_text(stanza).replace('"', '&quot;'))
+        prefix.append(' unbroken="1">')
+        for node, value in (('source', source), ('sourcetype', sourcetype), ('index', index), ('host', host)):
+            if value is not None:
+                prefix.append('<%s>%s</%s>' % (node, escape_xml_text(value), node))
+        prefix.append('<data>')
+        self.prefix = ''.join(prefix)
+        self.suffix = '</data><done /></event>'
+
+    def serialize(self, data):
+        return self.prefix + escape_xml_text(data) + self.suffix
+
+class HecEventSerializer(object):
+    """Serialize events as HTTP Event Collector JSON objects from a precomputed template.
+
+    Like XmlEventSerializer, the source, sourcetype and index members are encoded once and only the event
+    payload is encoded per event. The payload is sent as a string so _raw is the same JSON text the modular
+    input stream would index.
+    """
+
+    def __init__(self, source=None, sourcetype=None, index=None, host=None):
+        suffix = []
+        for key, value in (('source', source), ('sourcetype', sourcetype), ('index', index), ('host', host)):
+            if value is not None:
+                suffix.append(',%s:%s' % (json.dumps(key), json.dumps(value, ensure_ascii=False)))
+        suffix.append('}')
+        self.prefix = '{"event":'
+        self.suffix = ''.join(suffix)
+
+    def serialize(self, data):
+        return self.prefix + json.dumps(data, ensure_ascii=False) + self.suffix
+
+class SerializedEventBatch(object):
+    """Text of several serialized events, passed to EventWriter.write_event in place of one splunklib Event.
+
+    write_event only calls write_to on its argument, after writing the <stream> header if it is still due.
+    """
+
+    def __init__(self, text):
+        self.text = text
+
+    def write_to(self, stream):
+        stream.write(self.text)
+        stream.flush()
+
+class BufferedEventWriter(object):
+    """Drop-in replacement for the modular input EventWriter that writes events in batches.
+
+    splunklib's Event.write_to serializes one event and flushes the stream every time. Here events are
+    serialized into an in-memory buffer and handed to the EventWriter as one SerializedEventBatch, so the
+    stream gets one write and one flush per batch, once the batch reaches max_events, max_bytes or
+    max_seconds. Call flush() before the run ends.
+    """
+
+    def __init__(self, ew, max_events=EVENT_BATCH_MAX_EVENTS, max_bytes=EVENT_BATCH_MAX_BYTES, max_seconds=EVENT_BATCH_MAX_SECONDS):
+        self.ew = ew
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.buffer = io.StringIO()
+        self.buffered_events = 0
+        self.last_flush = time.time()
+
+    def new_serializer(self, source=None, sourcetype=None, index=None):
+        return XmlEventSerializer(source=source, sourcetype=sourcetype, index=index)
+
+    def write_serialized_event(self, serialized_event):
+        """Write an event already serialized by an XmlEventSerializer."""
+        self.buffer.write(serialized_event)
+        self.event_written()
+
+    def event_written(self):
+        self.buffered_events += 1
+        if (self.buffered_events >= self.max_events
+                or self.buffer.tell() >= self.max_bytes
+                or time.time() - self.last_flush >= self.max_seconds):
+            self.flush()
+
+    def close(self):
+        self.flush()
+
+    def flush(self):
+        if self.buffered_events:
+            self.ew.write_event(SerializedEventBatch(self.buffer.getvalue()))
+            self.buffer = io.StringIO()
+            self.buffered_events = 0
+        self.last_flush = time.time()
+
+class PipelinedHECEventWriter(HECEventWriter):
+    """HECEventWriter that posts pre-serialized, optionally gzip-compressed batches.
+
+    HECEventWriter.write_events formats and posts batches one after the other; post_batch posts a single batch
+    so HecBatchEventWriter can keep several of them in flight. Throttling responses are retried with the same
+    backoff as HECEventWriter.write_events.
+    """
+
+    def post_batch(self, payload, compress=False, retries=HECEventWriter.WRITE_EVENT_RETRIES):
+        body = payload.encode('utf-8')
+        headers = list(self.headers)
+        if compress:
+            body = gzip.compress(body)
+            headers.append(('Content-Encoding', 'gzip'))
+        
+        for i in range(retries):
+            try:
+                self._rest_client.post(self.HTTP_EVENT_COLLECTOR_ENDPOINT, body=body, headers=headers)
+                return
+            except binding.HTTPError as e:
+                if e.status not in (self.TOO_MANY_REQUESTS, self.SERVICE_UNAVAILABLE) or i == retries - 1:
+                    raise
+                time.sleep(min(((2 ** (i + 1)) * 5), 80) + random.uniform(0, 1))
+
+class HecBatchEventWriter(object):
+    """Event writer sending events to the HTTP Event Collector instead of the modular input stream.
+
+    Serialized events are packed into multi-event request bodies of up to HEC_BATCH_MAX_BYTES and posted by a
+    small thread pool, with at most max_in_flight requests outstanding; further writes block until one of them
+    completes. flush() sends the last partial batch, waits for every request and re-raises the first failure.
+    """
+
+    def __init__(self, helper, hec_input_name, compress=False, max_in_flight=HEC_MAX_IN_FLIGHT, max_bytes=HEC_BATCH_MAX_BYTES):
+        scheme, host, port = sutils.extract_http_scheme_host_port(helper.context_meta['server_uri'])
+        self.hec = PipelinedHECEventWriter(hec_input_name, helper.context_meta['session_key'], scheme, host, port)
+        self.compress = compress
+        # HECEventWriter reads max_content_length from the HEC limits while connecting.
+        self.max_bytes = min(max_bytes, HECEvent.max_hec_event_length)
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.futures = []
+
+    def new_serializer(self, source=None, sourcetype=None, index=None):
+        return HecEventSerializer(source=source, sourcetype=sourcetype, index=index)
+
+    def write_serialized_event(self, serialized_event):
+        size = len(serialized_event.encode('utf-8')) + 1
+        if self.buffer and self.buffered_bytes + size > self.max_bytes:
+            self.send_batch()
+        self.buffer.append(serialized_event)
+        self.buffered_bytes += size
+
+    def send_batch(self):
+        payload = '\n'.join(self.buffer)
+        self.buffer = []
+        self.buffered_bytes = 0
+        
+        self.raise_failures()
+        self.in_flight.acquire()
+        try:
+            future = self.executor.submit(self.hec.post_batch, payload, self.compress)
+        except Exception:
+            self.in_flight.release()
+            raise
+        future.add_done_callback(lambda f: self.in_flight.release())
+        self.futures.append(future)
+
+    def raise_failures(self):
+        pending = []
+        for future in self.futures:
+            if not future.done():
+                pending.append(future)
+            elif future.exception() is not None:
+                raise future.exception()
+        self.futures = pending
+
+    def flush(self):
+        if self.buffer:
+            self.send_batch()
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(wait=True)
+
+class ThreadedEventWriter(object):
+    """Event writer that hands serialized events to a dedicated writer thread through a bounded queue.
+
+    Collection threads only append to a list and enqueue it every batch_events events, so Graph requests are
+    not held up by a slow output and output continues while a Graph page is fetched. When no list arrives for
+    max_seconds, the writer thread takes the events collected so far and flushes the wrapped writer. The
+    queue holds at most max_batches lists; when it is full, writes block until the writer thread catches up.
+    The wrapped writer (BufferedEventWriter or HecBatchEventWriter) is only used from the writer thread. A
+    failure in the writer thread is re-raised to the collecting thread on its next enqueue or on close().
+    """
+
+    def __init__(self, writer, batch_events=WRITER_QUEUE_BATCH_EVENTS, max_batches=WRITER_QUEUE_MAX_BATCHES, max_seconds=EVENT_BATCH_MAX_SECONDS):
+        self.writer = writer
+        self.batch_events = batch_events
+        self.max_seconds = max_seconds
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=max_batches)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='event-writer', daemon=True)
+        self.thread.start()
+
+    def new_serializer(self, source=None, sourcetype=None, index=None):
+        return self.writer.new_serializer(source=source, sourcetype=sourcetype, index=index)
+
+    def write_serialized_event(self, serialized_event):
+        with self.pending_lock:
+            self.pending.append(serialized_event)
+            if len(self.pending) < self.batch_events:
+                return
+            events = self.take_pending()
+        self.enqueue(events)
+
+    def take_pending(self):
+        events = self.pending
+        self.pending = []
+        return events
+
+    def enqueue(self, item):
+        while True:
+            self.raise_failure()
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def raise_failure(self):
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    events = self.queue.get(timeout=self.max_seconds)
+                except queue.Empty:
+                    # Nothing new arrived, so push out what collection and the wrapped writer still hold.
+                    with self.pending_lock:
+                        events = self.take_pending()
+                    for serialized_event in events:
+                        self.writer.write_serialized_event(serialized_event)
+                    self.writer.flush()
+                    continue
+                if events is None:
+                    break
+                if isinstance(events, threading.Event):
+                    self.writer.flush()
+                    events.set()
+                    continue
+                for serialized_event in events:
+                    self.writer.write_serialized_event(serialized_event)
+            self.writer.close()
+        except Exception as e:
+            self.error = e
+
+    def flush(self):
+        """Wait until every event written so far has been passed to the wrapped writer and flushed."""
+        
+        with self.pending_lock:
+            events = self.take_pending()
+        if events:
+            self.enqueue(events)
+        
+        flushed = threading.Event()
+        self.enqueue(flushed)
+        while not flushed.wait(1):
+            self.raise_failure()
+
+    def close(self):
+        if self.thread.is_alive():
+            with self.pending_lock:
+                events = self.take_pending()
+            if events:
+                self.enqueue(events)
+            self.enqueue(None)
+            self.thread.join()
+        self.raise_failure()
+
+def get_event_writer(helper, ew):
+    
+    output_mode = helper.get_arg('output_mode') or 'modinput'
+    
+    if output_mode == 'hec':
+        hec_input_name = helper.get_arg('hec_input_name') or DEFAULT_HEC_INPUT_NAME
+        helper.log_info(f'Sending events to the HTTP Event Collector input {hec_input_name}.')
+        return ThreadedEventWriter(HecBatchEventWriter(helper, hec_input_name, bool(helper.get_arg('hec_compression'))))
+    
+    return ThreadedEventWriter(BufferedEventWriter(ew))
+
+class PolicyChangeIndex(object):
+    """Last written version of every matched policy, so unchanged policies are not written again on every run.
+
+    A policy's version is its modifiedDateTime, or a SHA-1 of its JSON when Graph reports none (policies that
+    were never modified). Policies that are new or whose version changed are written; all matched policies are
+    written again once snapshot_interval seconds have passed since the last full snapshot. The index is kept
+    in the checkpoint store and saved by save() once the events have been written.
+    """
+
+    def __init__(self, helper, snapshot_interval):
+        self.helper = helper
+        self.ckpt_key = f'{helper.get_input_stanza_names()}_policy_index'
+        self.now = int(time.time())
+        
+        previous = helper.get_check_point(self.ckpt_key) or {}
+        self.previous_versions = previous.get('versions', {})
+        self.last_full_snapshot = previous.get('last_full_snapshot', 0)
+        self.full_snapshot = self.now - self.last_full_snapshot >= snapshot_interval
+        if self.full_snapshot:
+            self.last_full_snapshot = self.now
+        self.versions = {}
+
+    def should_write(self, policy, data_event):
+        
+        version = policy.get('modifiedDateTime') or hashlib.sha1(data_event.encode('utf-8')).hexdigest()
+        self.versions[policy['id']] = version
+        
+        return self.full_snapshot or self.previous_versions.get(policy['id']) != version
+
+    def save(self):
+        self.helper.save_check_point(self.ckpt_key, {'last_full_snapshot': self.last_full_snapshot, 'versions': self.versions})
+
+def get_policy_change_index(helper):
+    
+    policy_snapshot_interval = helper.get_arg('policy_snapshot_interval')
+    
+    if not policy_snapshot_interval:
+        return None
+    
+    return PolicyChangeIndex(helper, int(policy_snapshot_interval))
+
+def ingest_direct_user_snapshots(helper, member_events, policies, users, snapshots):
+    
+    # Every policy is compared, including those without direct exclusions left, so removals are written too.
+    users_by_policy = {}
+    for u in users:
+        users_by_policy.setdefault(u['policyId'], set()).add(pack_guid(u['excludedUserId']))
+    
+    written = 0
+    for p in policies:
+        members = users_by_policy.get(p['id'], set())
+        written += snapshots.emit(member_events, [get_policy_entry(p)], f"direct_{p['id']}", "null", "Excluded from Policy Directly", members,
+                                  "Added to Policy Exclusions", "Removed from Policy Exclusions")
+    
+    helper.log_info(f'Direct CAP exclusions compared with the previous snapshot. {written} changes ingested.')
+
+def ingest_exempted_users(helper, ew, client, tenant_id, max_concurrency, deadline=None):
+    
+    pattern = helper.get_arg('policy_name')
+    policy_fields = helper.get_arg('policy_fields') or 'full'
+    
+    meta_source = f"ms_aad_user:tenant_id:{tenant_id}"
+    
+    policy_serializer = ew.new_serializer(source=meta_source, sourcetype='azure:aad:policy', index=helper.get_output_index())
+    resolver = None
+    if helper.get_arg('enrich_directory_objects'):
+        resolver = DirectoryObjectResolver(helper, client)
+    
+    collection_mode = get_collection_mode(helper)
+    
+    progress = None
+    run_events = False
+    if helper.get_arg('resumable_collection'):
+        if collection_mode == 'full':
+            progress = CollectionProgress(helper, ew)
+            run_events = True
+        else:
+            helper.log_warning(f'resumable_collection only applies to the full collection mode. Ignoring it for collection_mode={collection_mode}.')
+    elif deadline is not None and collection_mode == 'full':
+        # The groups left at the deadline must be saved for the next run, but the events keep the schema
+        # of a run without resumable_collection: no collectionRunId and no run events.
+        progress = CollectionProgress(helper, ew)
+    
+    member_events = new_member_event_writer(helper, ew, meta_source, resolver, progress.generation if run_events else None)
+    
+    shard_index, shard_count = get_shard(helper)
+    
+    # Each shard sees only its own groups and roles, so no shard can tell which users are exempted in total.
+    summary = None
+    if helper.get_arg('user_summary'):
+        if collection_mode != 'full':
+            helper.log_warning(f'user_summary only applies to the full collection mode. Ignoring it for collection_mode={collection_mode}.')
+        elif shard_count > 1:
+            helper.log_warning(f'user_summary only applies to unsharded inputs. Ignoring it for shard_count={shard_count}.')
+        else:
+            summary = ExemptUserSummary()
+            member_events = SummarizingMemberEventWriter(member_events, summary)
+    
+    pols = get_conditional_access_policies(helper, client, pattern, policy_fields)
+    
+    if shard_index == 0:
+        helper.log_info(f'Conditional Access Policies (CAP) retrieved. Ingesting all matched CAP as separate sourcetype.')
+    else:
+        helper.log_info(f'Conditional Access Policies (CAP) retrieved. Shard {shard_index} of {shard_count}: policies and direct exclusions are written by shard 0.')
+    
+    policy_index = get_policy_change_index(helper) if shard_index == 0 else None
+    policies_written = 0
+    
+    for p in (pols if shard_index == 0 else []):
+        data_event = json.dumps(p, separators=(',', ':'))
+        if policy_index is not None and not policy_index.should_write(p, data_event):
+            continue
+        ew.write_serialized_event(policy_serializer.serialize(data_event))
+        policies_written += 1
+    
+    if policy_index is not None:
+        helper.log_info(f'{policies_written} of {len(pols)} CAP written. full_snapshot={policy_index.full_snapshot}')
+    
+    helper.log_info(f'CAP ingested. Start of retrieving users. Firstly, all users who are directly excluded from CAP.')
+    
+    users = get_excluded_users_from_cap(helper, pols) if shard_index == 0 else []
+    
+    snapshots = None
+    if collection_mode != 'full':
+        snapshots = MembershipSnapshots(helper, pols)
+    
+    if shard_index != 0:
+        pass
+    elif progress is not None and progress.is_completed('direct_users'):
+        helper.log_info(f'Users directly excluded from CAP were already written by run {progress.generation}. Moving on to groups.')
+    elif collection_mode == 'snapshot':
+        ingest_direct_user_snapshots(helper, member_events, pols, users, snapshots)
+    elif len(users) == 0:
+        helper.log_info(f'Did not find users who are directly excluded from CAP. Moving on to groups.')
+    else:
+        helper.log_info(f'All users directly excluded from CAP retrieved. Now ingesting users...')
+        
+        # Each user is written on its own, so their directory objects are resolved in one go beforehand.
+        member_events.resolve([u['excludedUserId'] for u in users])
+        
+        for u in users:
+            member_events.write(u, u['excludedUserMemberOf'], u['excludedUserState'], [u['excludedUserId']])
+        
+        member_events.end()
+        
+        helper.log_info(f'All users directly excluded from CAP ingested. Start of retrieving groups excluded from CAP.')
+    
+    if progress is not None:
+        progress.step_written('direct_users')
+    
+    roles = get_excluded_roles_from_cap(helper, pols)
+    
+    if shard_count > 1:
+        roles = [r for r in roles if shard_of(r['excludedRoles'], shard_count) == shard_index]
+    
+    roles_left = roles_failed = 0
+    
+    if len(roles) == 0:
+        helper.log_info(f'Did not find directory roles in the CAP exclusion information.')
+    else:
+        roles_left, roles_failed = ingest_role_members(helper, member_events, client, roles, max_concurrency, snapshots, progress, deadline)
+    
+    groups = get_excluded_groups_from_cap(helper, pols)
+    groups_left = groups_failed = 0
+    
+    if shard_count > 1:
+        group_count = len({g['excludedGroups'] for g in groups})
+        groups = [g for g in groups if shard_of(g['excludedGroups'], shard_count) == shard_index]
+        helper.log_info(f'Shard {shard_index} of {shard_count} collects {len({g["excludedGroups"] for g in groups})} of {group_count} CAP-exclusion groups.')
+    
+    if len(groups) == 0:
+        helper.log_info(f'Did not find groups in the CAP exclusion information.')
+    else:
+        helper.log_info(f'All groups excluded from CAP retrieved. Now collecting members with max_concurrency={max_concurrency} collection_mode={collection_mode}...')
+        
+        if collection_mode == 'delta':
+            ingest_group_member_changes(helper, member_events, client, groups, max_concurrency, deadline)
+        elif collection_mode == 'snapshot':
+            ingest_group_member_snapshots(helper, member_events, client, groups, max_concurrency, snapshots, deadline)
+        else:
+            groups_left, groups_failed = ingest_group_members(helper, member_events, client, groups, max_concurrency, progress, deadline)
+    
+    # Saved only once every event is written, so an interrupted run compares against the same state again.
+    if policy_index is not None:
+        policy_index.save()
+    
+    if snapshots is not None:
+        snapshots.remove_unreferenced(member_events, ('group', 'role', 'direct') if collection_mode == 'snapshot' else ('role',))
+        snapshots.save()
+    
+    if resolver is not None:
+        resolver.save()
+    
+    if progress is not None and (groups_left or roles_left):
+        progress.save()
+        helper.log_info(f'Collection run {progress.generation} stopped at its deadline. Progress saved for the next run.')
+    elif progress is not None:
+        # Groups and roles that failed are not retried by this generation, it is reported as partial instead.
+        run_status = 'partial' if groups_failed or roles_failed else 'complete'
+        
+        if run_events:
+            run_serializer = ew.new_serializer(source=meta_source, sourcetype=RUN_SOURCETYPE, index=helper.get_output_index())
+            
+            xr = {}
+            xr['collectionRunId'] = progress.generation
+            xr['status'] = run_status
+            xr['resumed'] = progress.resumed
+            if groups_failed or roles_failed:
+                xr['failedGroups'] = groups_failed
+                xr['failedRoles'] = roles_failed
+            
+            ew.write_serialized_event(run_serializer.serialize(json.dumps(xr, separators=(',', ':'))))
+            ew.flush()
+        
+        progress.finish()
+        helper.log_info(f"Collection run {progress.generation} {run_status}. failedGroups={groups_failed} failedRoles={roles_failed}")
+    
+    # A resumed run, or one that stopped or failed part-way, has seen only part of the members.
+    if summary is not None and ((progress is not None and progress.resumed) or groups_left or roles_left or groups_failed or roles_failed):
+        helper.log_warning(f'Unique exempt user summary not written: this run did not read every excluded group and directory role in full.')
+    elif summary is not None:
+        summary_serializer = ew.new_serializer(source=meta_source, sourcetype=SUMMARY_SOURCETYPE, index=helper.get_output_index())
+        user_count = summary.write(ew, summary_serializer)
+        helper.log_info(f'Unique exempt user summary written for {user_count} users.')
+    
+    helper.log_info(f"Ingestion of all users was successful. End of collection.")
+    
@@ -58,6 +58,70 @@ class ModInputconditional_access_policy_exempted_users(modinput_wrapper.base_mod
                                          description="",
                                          required_on_create=True,
                                          required_on_edit=False))
+        scheme.add_argument(smi.Argument("max_concurrency", title="Max Concurrency",
+                                         description="Maximum number of excluded groups whose members are fetched from Microsoft Graph in parallel. Defaults to 8.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("collection_mode", title="Collection Mode",
+                                         description="Full emits every member of every excluded group on each run. Delta emits every member once, then only the members added to or removed from excluded groups since the previous run. Snapshot reads every member like Full but compares each group with the member set saved by the previous run, and only emits the members added to or removed from it (including direct exclusions).",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("expand_nested_groups", title="Expand Nested Groups",
+                                         description="Resolve users who are members of excluded groups through nested groups. Nested groups are then not reported as members themselves. Only applies to the full and snapshot collection modes.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("page_size", title="Member Page Size",
+                                         description="Number of group members requested per Microsoft Graph page ($top), between 1 and 999. Defaults to 999.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("policy_fields", title="Policy Fields",
+                                         description="Full ingests complete policy objects as azure:aad:policy events. Minimal only requests and ingests id, displayName, state, modifiedDateTime and conditions.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("output_mode", title="Output Mode",
+                                         description="Modular Input writes events to the modular input XML stream. HTTP Event Collector sends them to Splunk HEC in batched, pipelined requests.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("hec_input_name", title="HEC Input Name",
+                                         description="Name of the HTTP Event Collector input used when Output Mode is HTTP Event Collector. It is created if it does not exist.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("hec_compression", title="HEC Compression",
+                                         description="Gzip-compress the requests sent to the HTTP Event Collector.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("event_schema", title="Event Schema",
+                                         description="Per User writes one azure:aad:user:capexempts event per exempted user and policy. Aggregated writes one azure:aad:user:capexempts:aggregated event per policy and group, holding the member ids in excludedUserIds (split into chunks of at most 500 ids).",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("user_summary", title="Unique Exempt User Summary",
+                                         description="Also write one azure:aad:user:capexempts:summary event per exempted user at the end of each run, listing every policy and path (direct or group) that exempts the user. Full collection mode and unsharded inputs only; runs that resume, stop at their deadline or fail to read a group or role write no summary.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("policy_snapshot_interval", title="Policy Snapshot Interval",
+                                         description="Seconds between full policy snapshots. When set, an azure:aad:policy event is only written for policies that are new or whose modifiedDateTime changed since the previous run, and every matched policy is written again once this interval has passed. Leave empty to write every matched policy on each run.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("enrich_directory_objects", title="Enrich Directory Objects",
+                                         description="Add the userPrincipalName, displayName and accountEnabled of each exempted user and the displayName of the excluded group to member events. Objects are resolved through Microsoft Graph directoryObjects/getByIds and cached for a day. Requires the Directory.Read.All application permission.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("resumable_collection", title="Resumable Collection",
+                                         description="Full collection mode only. Save the groups already written and the next page link of the group in progress in the checkpoint store while the input runs, so a run that was stopped part-way resumes where it stopped. Member events then carry a collectionRunId, and an azure:aad:user:capexempts:run event marks the run as complete.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("max_runtime_seconds", title="Max Runtime Seconds",
+                                         description="Time budget of one run, in seconds. Work is done in order of priority: policies, directly excluded users, directory roles, then groups from the smallest to the largest. No new Microsoft Graph requests are started once the budget is nearly used up, and in the full collection mode the progress is saved so the next run continues with the groups left. Events keep their schema: collectionRunId and run events are only added by Resumable Collection. Leave empty for no limit.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("shard_count", title="Shard Count",
+                                         description="Number of inputs that share the collection of this tenant. Each input collects only the excluded groups and directory roles whose id hashes into its shard. Each shard writes its own run events and collectionRunId, and the unique exempt user summary is not available. Leave empty for a single input.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("shard_index", title="Shard Index",
+                                         description="Shard of this input, from 0 to Shard Count - 1. Only shard 0 writes policy events and directly excluded users.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
         return scheme
 
     def get_app_name(self):
@@ -78,6 +142,11 @@ class ModInputconditional_access_policy_exempted_users(modinput_wrapper.base_mod
 
     def get_checkbox_fields(self):
         checkbox_fields = []
+        checkbox_fields.append("expand_nested_groups")
+        checkbox_fields.append("hec_compression")
+        checkbox_fields.append("user_summary")
+        checkbox_fields.append("enrich_directory_objects")
+        checkbox_fields.append("resumable_collection")
         return checkbox_fields
 
     def get_global_checkbox_fields(self):
@@ -1,9 +1,22 @@
-
 # encoding = utf-8
 
-import requests
-import json
-import re
+import time
+
+from solnlib import utils as sutils
+
+from cap_exempted_users_collector import (
+    COLLECTION_MODES,
+    EVENT_SCHEMAS,
+    MAX_PAGE_SIZE,
+    OUTPUT_MODES,
+    POLICY_FIELDS,
+    GraphClient,
+    get_bearer_token,
+    get_deadline,
+    get_event_writer,
+    get_max_concurrency,
+    ingest_exempted_users,
+)
 
 '''
     IMPORTANT
@@ -23,236 +36,74 @@ def validate_input(helper, definition):
     # policy_name = definition.parameters.get('policy_name', None)
     # client_id = definition.parameters.get('client_id', None)
     # tenant_id = definition.parameters.get('tenant_id', None)
-    pass
-
-def get_bearer_token(helper, client_id, client_secret, tenant_id):
-    
-    token_url = f'https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token'
-    
-    data = {
-        'grant_type': 'client_credentials',
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'scope': 'https://graph.microsoft.com/.default'
-    }
-    
-    try:
-        
-        helper.log_info("Obtaining access token...")
-        
-        response = requests.post(token_url, data=data)
-        response.raise_for_status()
-        token_info = response.json()
-        
-        helper.log_info(f"Access token for client id {client_id} has been granted...")
-        
-        return token_info['access_token']
-    except requests.RequestException as e:
-        helper.log_error(f"Error obtaining token: {e}")
-        return None
-
-def get_conditional_access_policies(helper, access_token, policyNameRegex):
-    
-    graph_url = 'https://graph.microsoft.com/v1.0/'
-    conditional_policy_url = graph_url + 'identity/conditionalAccess/policies'
-    
-    headers = {
-        'Authorization': 'Bearer ' + access_token,
-        'Content-Type': 'application/json'
-    }
-    
-    policies = []
-    policies_reduced = []
-    
-    helper.log_info(f'Retrieving Conditional Access Policies matching regex={policyNameRegex}')
-    
-    response = requests.get(conditional_policy_url, headers=headers)
-    
-    if response.status_code == 200:
-            
-        policies = response.json()
-        policies_reduced.extend(policies['value'])
-        
-        while '@odata.nextLink' in policies:
-            next_link = policies['@odata.nextLink']
-            response_next_page = requests.get(next_link, headers=headers)
-            if response_next_page.status_code == 200:
-                policies = response.json()
-                policies_reduced.extend(policies['value'])
-            else:
-                helper.log_error('Error occurred. status_code={str(response_next_page.status_code)} {response_next_page.text}')
-                break
-        
-        filtered_policies_reduced = [item for item in policies_reduced if re.search(policyNameRegex, item.get('displayName', ''), re.IGNORECASE)]
-        
-        return filtered_policies_reduced
-        
-        helper.log_info(f'All conditional access policies in cache. count={len(policies_reduced)}')
-            
-    else:
-        helper.log_error(f'Error occurred. status_code={str(response.status_code)} {response.text}')
- 
-def get_excluded_groups_from_cap(helper, policies):
-    
-    if policies is None: 
-        helper.log_warning(f'Unable to retrieve excluded groups because policies list is empty.')
-        return
-    
-    groups = []
-    
-    for p in policies:
-        for g in p['conditions']['users']['excludeGroups']:
-            xg = {}
-            xg['policyId'] = p['id']
-            xg['policyDisplayName'] = p['displayName']
-            xg['policyState'] = p['state']
-            xg['policyLastModifiedDateTime'] = p['modifiedDateTime']
-            xg['excludedGroups'] = g
-            groups.append(xg)
-    
-    return groups
-    
-def get_excluded_users_from_cap(helper, policies):
-    
-    if policies is None: 
-        helper.log_warning(f'Unable to retrieve excluded users because policies list is empty.')
-        return
-    
-    users = []
-    
-    for p in policies:
-        for u in p['conditions']['users']['excludeUsers']:
-            xu = {}
-            xu['policyId'] = p['id']
-            xu['policyDisplayName'] = p['displayName']
-            xu['policyState'] = p['state']
-            xu['policyLastModifiedDateTime'] = p['modifiedDateTime']
-            xu['excludedUserMemberOf'] = "null"
-            xu['excludedUserState'] = "Excluded from Policy Directly"
-            xu['excludedUserId'] = u
-            users.append(xu)
-    
-    return users
-
-def get_group_members(helper, access_token, group_id):
-    
-    graph_url = 'https://graph.microsoft.com/v1.0/'
-    group_members_url = graph_url + f'groups/{group_id}/members?$select=id'
-
-    headers = {
-        'Authorization': 'Bearer ' + access_token,
-        'Content-Type': 'application/json'
-    }
-
-    all_group_members_details = []
-    
-    helper.log_info(f"Retrieving members of {group_id}")
-
-    response = requests.get(group_members_url, headers=headers)
-    
-    page_counter = 1
-    
-    if response.status_code == 200:
-        group_members_details = response.json()
-        
-        all_group_members_details.extend(group_members_details['value'])
-        
-        while '@odata.nextLink' in group_members_details:
-            
-            page_counter = page_counter + 1
-            
-            if page_counter == 2:
-                print(f"Group {group_id} has multiple pages.")
-            
-            next_link = group_members_details['@odata.nextLink']
-            response = requests.get(next_link, headers=headers)
-            if response.status_code == 200:
-                group_members_details = response.json()
-                all_group_members_details.extend(group_members_details['value'])
-            else:
-                helper.log_error(f'Error occurred. Status={str(response.status_code)}', response.text)
-                continue
-        
-        if page_counter > 1:
-            helper.log_info(f"Group {group_id} ended collecting all members at page {str(page_counter)}.")
-        
-        return all_group_members_details
-
-    else:
-        helper.log_error(f'Error occurred. Status={str(response.status_code)}', response.text)
+    max_concurrency = definition.parameters.get('max_concurrency', None)
+    if max_concurrency and (not str(max_concurrency).isdigit() or int(max_concurrency) < 1):
+        raise ValueError(f'max_concurrency must be a positive integer. Got: {max_concurrency}')
+    page_size = definition.parameters.get('page_size', None)
+    if page_size and (not str(page_size).isdigit() or not 1 <= int(page_size) <= MAX_PAGE_SIZE):
+        raise ValueError(f'page_size must be an integer between 1 and {MAX_PAGE_SIZE}. Got: {page_size}')
+    policy_fields = definition.parameters.get('policy_fields', None)
+    if policy_fields and policy_fields not in POLICY_FIELDS:
+        raise ValueError(f'policy_fields must be one of {", ".join(POLICY_FIELDS)}. Got: {policy_fields}')
+    event_schema = definition.parameters.get('event_schema', None)
+    if event_schema and event_schema not in EVENT_SCHEMAS:
+        raise ValueError(f'event_schema must be one of {", ".join(EVENT_SCHEMAS)}. Got: {event_schema}')
+    output_mode = definition.parameters.get('output_mode', None)
+    if output_mode and output_mode not in OUTPUT_MODES:
+        raise ValueError(f'output_mode must be one of {", ".join(OUTPUT_MODES)}. Got: {output_mode}')
+    collection_mode = definition.parameters.get('collection_mode', None)
+    if collection_mode and collection_mode not in COLLECTION_MODES:
+        raise ValueError(f'collection_mode must be one of {", ".join(COLLECTION_MODES)}. Got: {collection_mode}')
+    user_summary = definition.parameters.get('user_summary', None)
+    if sutils.is_true(user_summary) and (collection_mode or 'full') != 'full':
+        raise ValueError(f'user_summary requires collection_mode=full. Got: {collection_mode}')
+    policy_snapshot_interval = definition.parameters.get('policy_snapshot_interval', None)
+    if policy_snapshot_interval and not str(policy_snapshot_interval).isdigit():
+        raise ValueError(f'policy_snapshot_interval must be a non-negative integer. Got: {policy_snapshot_interval}')
+    max_runtime_seconds = definition.parameters.get('max_runtime_seconds', None)
+    if max_runtime_seconds and (not str(max_runtime_seconds).isdigit() or int(max_runtime_seconds) < 1):
+        raise ValueError(f'max_runtime_seconds must be a positive integer. Got: {max_runtime_seconds}')
+    shard_count = definition.parameters.get('shard_count', None)
+    shard_index = definition.parameters.get('shard_index', None)
+    if shard_count and (not str(shard_count).isdigit() or int(shard_count) < 1):
+        raise ValueError(f'shard_count must be a positive integer. Got: {shard_count}')
+    if shard_index and (not str(shard_index).isdigit() or int(shard_index) >= int(shard_count or 1)):
+        raise ValueError(f'shard_index must be an integer from 0 to shard_count - 1. Got: {shard_index}')
+    if sutils.is_true(user_summary) and int(shard_count or 1) > 1:
+        raise ValueError(f'user_summary requires a single input. Got: shard_count={shard_count}')
 
 def collect_events(helper, ew):
     
     helper.log_info(f'Start of collection.')
     
+    deadline = get_deadline(helper, time.time())
+    
     opt_global_account = helper.get_arg('client_id')
     client_id = opt_global_account['username']
     client_secret = opt_global_account['password']
     tenant_id = helper.get_arg('tenant_id')
-    pattern = helper.get_arg('policy_name')
+    max_concurrency = get_max_concurrency(helper)
     
     llvl = helper.get_log_level()
     helper.set_log_level(llvl)
     helper.log_info(f"Loging level is set to: {llvl}")
     
+    client = GraphClient(helper, pool_size=max_concurrency)
+    client.deadline = deadline
+    event_writer = get_event_writer(helper, ew)
     
-    token = get_bearer_token(helper, client_id, client_secret, tenant_id)
-    
-    meta_source = f"ms_aad_user:tenant_id:{tenant_id}"
-    
-    pols = get_conditional_access_policies(helper, token, pattern)
-    
-    helper.log_info(f'Conditional Access Policies (CAP) retrieved. Ingesting all matched CAP as separate sourcetype.')
-    
-    for p in pols:
-        data_event = json.dumps(p, separators=(',', ':'))
-        event = helper.new_event(source=meta_source, index=helper.get_output_index(), sourcetype='azure:aad:policy', data=data_event)
-        ew.write_event(event)
-    
-    helper.log_info(f'CAP ingested. Start of retrieving users. Firstly, all users who are directly excluded from CAP.')
-    
-    users = get_excluded_users_from_cap(helper, pols)
-    
-    if len(users) == 0:
-        helper.log_info(f'Did not find users who are directly excluded from CAP. Moving on to groups.')
-    else:
-        helper.log_info(f'All users directly excluded from CAP retrieved. Now ingesting users...')
+    try:
         
-        for u in users:
-            data_event = json.dumps(u, separators=(',', ':'))
-            event = helper.new_event(source=meta_source, index=helper.get_output_index(), sourcetype=helper.get_sourcetype(), data=data_event)
-            ew.write_event(event)
-            
-        helper.log_info(f'All users directly excluded from CAP ingested. Start of retrieving groups excluded from CAP.')
-    
-    groups = get_excluded_groups_from_cap(helper, pols)
-    
-    if len(groups) == 0:
-        helper.log_info(f'Did not find groups in the CAP exclusion information. End of collection.')
-        return
-    
-    helper.log_info(f'All groups excluded from CAP retrieved. Now collecting members...')
-    
-    for g in groups:
+        token, expires_on = get_bearer_token(helper, client, client_id, client_secret, tenant_id)
         
-        gid = g['excludedGroups']
-        members = get_group_members(helper, token, gid)
+        if token is None:
+            helper.log_error(f'Unable to obtain an access token for client id {client_id}. End of collection.')
+            return
         
-        helper.log_info(f'All members of CAP-exclusion group {gid} retrieved. Now ingesting users/members...')
-               
-        for m in members:
-            xu = {}
-            xu['policyId'] = g['policyId']
-            xu['policyDisplayName'] = g['policyDisplayName']
-            xu['policyState'] = g['policyState']
-            xu['policyLastModifiedDateTime'] = g['policyLastModifiedDateTime']
-            xu['excludedUserMemberOf'] = gid
-            xu['excludedUserState'] = "Excluded from Policy via Group"
-            xu['excludedUserId'] = m['id']
-            
-            data_event = json.dumps(xu, separators=(',', ':'))
-            event = helper.new_event(source=meta_source, index=helper.get_output_index(), sourcetype=helper.get_sourcetype(), data=data_event)
-            ew.write_event(event)
-    
-    helper.log_info(f"Ingestion of all users was successful. End of collection.")
+        client.set_access_token(token, expires_on, lambda: get_bearer_token(helper, client, client_id, client_secret, tenant_id))
+        
+        ingest_exempted_users(helper, event_writer, client, tenant_id, max_concurrency, deadline)
     
+    finally:
+        event_writer.close()
+        client.close()
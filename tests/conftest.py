@@ -0,0 +1,7 @@
+import os
+import sys
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'TA-microsoft_azure_cap_exempted_users', 'bin')
+sys.path.insert(0, BIN_DIR)
+
+import ta_microsoft_azure_cap_exempted_users_declare
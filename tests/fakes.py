@@ -0,0 +1,294 @@
+"""In-memory stand-ins for Microsoft Graph, the AOB helper and the event writer used by the tests."""
+
+import json
+import re
+import threading
+import time
+import urllib.parse
+import warnings
+
+import requests
+
+from solnlib import credentials
+from solnlib.modular_input import checkpointer
+
+import cap_exempted_users_collector as collector
+
+
+def guid(n):
+    return f'00000000-0000-4000-8000-{n:012x}'
+
+
+def policy(policy_id, users=(), groups=(), roles=()):
+    return {
+        'id': policy_id,
+        'displayName': 'Policy ' + policy_id,
+        'state': 'enabled',
+        'modifiedDateTime': '2024-01-01T00:00:00Z',
+        'conditions': {'users': {'excludeUsers': list(users), 'excludeGroups': list(groups), 'excludeRoles': list(roles)}},
+    }
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {}
+        self.text = json.dumps(body)
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'{self.status_code} error')
+
+
+class FakeGraphClient(object):
+    """Answers the Graph requests of a collection run from dicts of policies, group members and role members.
+
+    Member lists are served page_size members per page. directoryObjects/getByIds answers from objects, a dict of
+    object id to its fields, and records the ids asked for in resolved_ids. fail maps a URL fragment to the status returned for
+    every request whose URL contains it, and on_request, when set, is called with each URL before it is answered.
+    """
+
+    def __init__(self, policies=(), groups=None, roles=None, page_size=2, objects=None):
+        self.policies = list(policies)
+        self.groups = groups or {}
+        self.roles = roles or {}
+        self.objects = objects or {}
+        self.resolved_ids = []
+        self.page_size = page_size
+        self.fail = {}
+        self.on_request = None
+        self.requests = []
+        self.tokens_issued = 0
+        self.delta_tokens = {}
+        self.lock = threading.Lock()
+        self.rate_controller = collector.GraphRateController(8)
+        self.deadline = None
+
+    def get(self, url, params=None, **kwargs):
+        if params:
+            url += ('&' if '?' in url else '?') + urllib.parse.urlencode(params)
+        return self.request('GET', url)
+
+    def post(self, url, json=None, **kwargs):
+        return self.request('POST', url, json)
+
+    def request(self, method, url, body=None):
+        if url.startswith(collector.GRAPH_URL):
+            url = url[len(collector.GRAPH_URL):]
+        with self.lock:
+            self.requests.append((method, url))
+        if self.on_request is not None:
+            self.on_request(url)
+        for fragment, status in self.fail.items():
+            if fragment in url:
+                return FakeResponse(status, {'error': {'code': str(status)}})
+        return self.route(url, body)
+
+    def route(self, url, body):
+        if url.startswith('https://login.microsoftonline.com/'):
+            self.tokens_issued += 1
+            return FakeResponse(200, {'access_token': f'token-{self.tokens_issued}', 'expires_in': 3599})
+
+        parsed = urllib.parse.urlparse(url)
+        path = parsed.path
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+
+        if path == 'identity/conditionalAccess/policies':
+            return FakeResponse(200, {'value': self.policies})
+
+        if path == '$batch':
+            responses = []
+            for r in body['requests']:
+                sub = self.request('GET', r['url'].lstrip('/'))
+                responses.append({'id': r['id'], 'status': sub.status_code, 'headers': {}, 'body': sub.json()})
+            return FakeResponse(200, {'responses': responses})
+
+        if path.startswith('groups/') and path.endswith('/members'):
+            group_id = path.split('/')[1]
+            if group_id not in self.groups:
+                return FakeResponse(404, {'error': {'code': 'Request_ResourceNotFound'}})
+            return FakeResponse(200, self.page(f'groups/{group_id}/members', self.groups[group_id], query))
+
+        if path == 'directoryObjects/getByIds':
+            self.resolved_ids.extend(body['ids'])
+            return FakeResponse(200, {'value': [dict(self.objects[i], id=i) for i in body['ids'] if i in self.objects]})
+
+        if path == 'groups/delta':
+            return FakeResponse(200, self.delta(query))
+
+        if path.startswith("directoryRoles(roleTemplateId='"):
+            role_id = path.split("'")[1]
+            if role_id not in self.roles:
+                return FakeResponse(404, {'error': {'code': 'Request_ResourceNotFound'}})
+            return FakeResponse(200, self.page(path, self.roles[role_id], query))
+
+        return FakeResponse(404, {'error': {'code': 'NotFound', 'path': path}})
+
+    def page(self, path, members, query):
+        skip = int(query.get('$skiptoken', 0))
+        body = {'value': [{'@odata.type': '#microsoft.graph.user', 'id': m} for m in members[skip:skip + self.page_size]]}
+        if skip + self.page_size < len(members):
+            body['@odata.nextLink'] = f'{collector.GRAPH_URL}{path}?$select=id&$skiptoken={skip + self.page_size}'
+        return body
+
+    def delta(self, query):
+        """groups/delta with members@delta: changes of the filtered groups since the state saved in the delta token."""
+        if '$deltatoken' in query:
+            previous = self.delta_tokens[query['$deltatoken']]
+        else:
+            previous = {gid: [] for gid in re.findall(r"id eq '([^']+)'", query['$filter'])}
+        value = []
+        for gid, old in previous.items():
+            current = self.groups.get(gid, [])
+            changes = [{'@odata.type': '#microsoft.graph.user', 'id': m} for m in current if m not in old]
+            changes += [{'@odata.type': '#microsoft.graph.user', 'id': m, '@removed': {'reason': 'deleted'}} for m in old if m not in current]
+            if changes:
+                value.append({'id': gid, 'members@delta': changes})
+        token = str(len(self.delta_tokens))
+        self.delta_tokens[token] = {gid: list(self.groups.get(gid, [])) for gid in previous}
+        return {'value': value, '@odata.deltaLink': f'{collector.GRAPH_URL}groups/delta?$deltatoken={token}'}
+
+    def requested(self, fragment):
+        return [url for method, url in self.requests if fragment in url]
+
+
+class FakeHelper(object):
+    """The parts of the AOB modular input helper used by the collector, with an in-memory checkpoint store."""
+
+    def __init__(self, args=None, checkpoints=None):
+        self.args = dict(args or {})
+        self.checkpoints = checkpoints if checkpoints is not None else {}
+        self.logs = []
+        self.context_meta = {'server_uri': 'https://127.0.0.1:8089', 'session_key': 'session-key'}
+
+    def get_arg(self, name):
+        return self.args.get(name)
+
+    def get_input_stanza_names(self):
+        return 'test_input'
+
+    def get_app_name(self):
+        return 'TA-microsoft_azure_cap_exempted_users'
+
+    def get_output_index(self):
+        return 'main'
+
+    def get_sourcetype(self):
+        return 'azure:aad:user:capexempts'
+
+    def get_proxy(self):
+        return {}
+
+    def get_check_point(self, key):
+        return json.loads(json.dumps(self.checkpoints[key])) if key in self.checkpoints else None
+
+    def save_check_point(self, key, state):
+        self.checkpoints[key] = json.loads(json.dumps(state))
+
+    def batch_save_check_point(self, states):
+        # Like solnlib's Checkpointer.batch_update, which AOB calls with states as given: a list of documents.
+        for state in states:
+            self.save_check_point(state['_key'], state['state'])
+
+    def delete_check_point(self, key):
+        self.checkpoints.pop(key, None)
+
+    def log_debug(self, msg):
+        self.logs.append(('DEBUG', msg))
+
+    def log_info(self, msg):
+        self.logs.append(('INFO', msg))
+
+    def log_warning(self, msg):
+        self.logs.append(('WARNING', msg))
+
+    def log_error(self, msg):
+        self.logs.append(('ERROR', msg))
+
+
+class FileCheckpointHelper(FakeHelper):
+    """FakeHelper keeping its checkpoints in a solnlib FileCheckpointer, as AOB does with AOB_TEST set."""
+
+    def __init__(self, checkpoint_dir, args=None):
+        super().__init__(args)
+        with warnings.catch_warnings():
+            # Deprecated in favour of the KV Store, but both take the same batch_update documents.
+            warnings.simplefilter('ignore')
+            self.ckpt = checkpointer.FileCheckpointer(checkpoint_dir)
+
+    def get_check_point(self, key):
+        return self.ckpt.get(key)
+
+    def save_check_point(self, key, state):
+        self.ckpt.update(key, state)
+
+    def batch_save_check_point(self, states):
+        self.ckpt.batch_update(states)
+
+    def delete_check_point(self, key):
+        self.ckpt.delete(key)
+
+
+class FakeCredentialManager(object):
+    """solnlib CredentialManager keeping the passwords of every instance in one class-level dict."""
+
+    passwords = {}
+
+    def __init__(self, session_key, app, owner='nobody', realm=None, **kwargs):
+        self.realm = realm
+
+    def get_password(self, user):
+        try:
+            return self.passwords[(self.realm, user)]
+        except KeyError:
+            raise credentials.CredentialNotExistException(f'Failed to get password of realm={self.realm}, user={user}.')
+
+    def set_password(self, user, password):
+        self.passwords[(self.realm, user)] = password
+
+
+class RecordingSerializer(object):
+
+    def __init__(self, sourcetype):
+        self.sourcetype = sourcetype
+
+    def serialize(self, data):
+        return self.sourcetype, data
+
+
+class RecordingEventWriter(object):
+    """Event writer keeping the (sourcetype, data) of every event written, in order."""
+
+    def __init__(self):
+        self.events = []
+        self.flushes = 0
+
+    def new_serializer(self, source=None, sourcetype=None, index=None):
+        return RecordingSerializer(sourcetype)
+
+    def write_serialized_event(self, serialized_event):
+        self.events.append(serialized_event)
+
+    def flush(self):
+        self.flushes += 1
+
+    def close(self):
+        self.flush()
+
+    def data(self, sourcetype='azure:aad:user:capexempts'):
+        return [json.loads(data) for st, data in self.events if st == sourcetype]
+
+
+def slow_down(client, fragment, seconds):
+    """Delay the answer to every request of client whose URL contains fragment."""
+
+    def on_request(url):
+        if fragment in url:
+            time.sleep(seconds)
+
+    client.on_request = on_request
@@ -0,0 +1,180 @@
+import time
+
+import cap_exempted_users_collector as collector
+
+from fakes import FakeGraphClient, FakeHelper, FileCheckpointHelper, RecordingEventWriter, policy
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptingEventWriter(RecordingEventWriter):
+    """Fails the run when it is asked to write its limit + 1st member event."""
+
+    def __init__(self, limit, sourcetype='azure:aad:user:capexempts'):
+        super().__init__()
+        self.limit = limit
+        self.sourcetype = sourcetype
+
+    def write_serialized_event(self, serialized_event):
+        if serialized_event[0] == self.sourcetype and len(self.data(self.sourcetype)) == self.limit:
+            raise Interrupted()
+        super().write_serialized_event(serialized_event)
+
+
+def test_interrupted_run_resumes_where_it_stopped(monkeypatch):
+    monkeypatch.setattr(collector, 'RUN_PROGRESS_SAVE_SECONDS', 0)
+    groups = {'g1': ['a1', 'a2', 'a3'], 'g2': ['b1', 'b2', 'b3', 'b4', 'b5', 'b6'], 'g3': ['c1', 'c2', 'c3']}
+    client = FakeGraphClient([policy('p1', groups=list(groups))], groups)
+    helper = FakeHelper({'policy_name': '.', 'resumable_collection': '1'})
+
+    first = InterruptingEventWriter(limit=5)
+    try:
+        collector.ingest_exempted_users(helper, first, client, 'tenant', 2)
+    except Interrupted:
+        pass
+    else:
+        raise AssertionError('the run was not interrupted')
+
+    client.requests = []
+    second = RecordingEventWriter()
+    collector.ingest_exempted_users(helper, second, client, 'tenant', 2)
+
+    written = [e['excludedUserId'] for e in first.data() + second.data()]
+    assert written == groups['g1'] + groups['g2'] + groups['g3']
+    assert not client.requested('groups/g1/')
+    assert client.requested('groups/g2/members?$select=id&$skiptoken=2')
+
+    run_ids = {e['collectionRunId'] for e in first.data() + second.data()}
+    assert len(run_ids) == 1
+    assert second.data(collector.RUN_SOURCETYPE) == [{'collectionRunId': run_ids.pop(), 'status': 'complete', 'resumed': True}]
+    assert 'test_input_run_progress' not in helper.checkpoints
+
+
+def test_progress_is_saved_through_the_solnlib_checkpointer(monkeypatch, tmp_path):
+    monkeypatch.setattr(collector, 'RUN_PROGRESS_SAVE_SECONDS', 0)
+    groups = {'g1': ['a1', 'a2', 'a3'], 'g2': ['b1', 'b2', 'b3']}
+    client = FakeGraphClient([policy('p1', groups=list(groups))], groups)
+    helper = FileCheckpointHelper(str(tmp_path), {'policy_name': '.', 'resumable_collection': '1'})
+
+    first = InterruptingEventWriter(limit=3)
+    try:
+        collector.ingest_exempted_users(helper, first, client, 'tenant', 2)
+    except Interrupted:
+        pass
+
+    assert helper.get_check_point('test_input_run_progress')['completed'] == ['direct_users', 'g1']
+
+    second = RecordingEventWriter()
+    collector.ingest_exempted_users(helper, second, client, 'tenant', 2)
+
+    assert [e['excludedUserId'] for e in first.data() + second.data()] == groups['g1'] + groups['g2']
+    assert helper.get_check_point('test_input_run_progress') is None
+
+
+def test_roles_not_read_before_the_deadline_are_left_for_the_next_run(tmp_path):
+    client = FakeGraphClient([policy('p1', groups=['g1'], roles=['r1'])], {'g1': ['a1']}, roles={'r1': ['x1', 'x2']})
+    helper = FileCheckpointHelper(str(tmp_path), {'policy_name': '.', 'max_runtime_seconds': '1'})
+
+    first = RecordingEventWriter()
+    collector.ingest_exempted_users(helper, first, client, 'tenant', 2, deadline=time.time() - 1)
+
+    assert first.data() == []
+    assert helper.get_check_point('test_input_run_progress') is not None
+
+    second = RecordingEventWriter()
+    collector.ingest_exempted_users(helper, second, client, 'tenant', 2, deadline=time.time() + 60)
+
+    assert [(e['excludedUserMemberOf'], e['excludedUserId']) for e in second.data()] == [('r1', 'x1'), ('r1', 'x2'), ('g1', 'a1')]
+    assert helper.get_check_point('test_input_run_progress') is None
+
+
+def test_time_budget_alone_keeps_the_event_schema(monkeypatch):
+    monkeypatch.setattr(collector, 'RUN_PROGRESS_SAVE_SECONDS', 0)
+    client = FakeGraphClient([policy('p1', groups=['g1'])], {'g1': ['a1', 'a2', 'a3']})
+    helper = FakeHelper({'policy_name': '.', 'max_runtime_seconds': '60'})
+    ew = RecordingEventWriter()
+
+    collector.ingest_exempted_users(helper, ew, client, 'tenant', 2, deadline=time.time() + 60)
+
+    assert [e['excludedUserId'] for e in ew.data()] == ['a1', 'a2', 'a3']
+    assert not any('collectionRunId' in e for e in ew.data())
+    assert ew.data(collector.RUN_SOURCETYPE) == []
+
+
+def test_roles_written_before_an_interruption_are_not_written_again(monkeypatch):
+    monkeypatch.setattr(collector, 'RUN_PROGRESS_SAVE_SECONDS', 0)
+    client = FakeGraphClient([policy('p1', groups=['g1'], roles=['r1', 'r2'])], {'g1': ['a1', 'a2']}, roles={'r1': ['x1'], 'r2': ['y1']})
+    helper = FakeHelper({'policy_name': '.', 'resumable_collection': '1'})
+
+    first = InterruptingEventWriter(limit=2)
+    try:
+        collector.ingest_exempted_users(helper, first, client, 'tenant', 2)
+    except Interrupted:
+        pass
+
+    second = RecordingEventWriter()
+    collector.ingest_exempted_users(helper, second, client, 'tenant', 2)
+
+    assert [e['excludedUserId'] for e in first.data() + second.data()] == ['x1', 'y1', 'a1', 'a2']
+
+
+def test_run_with_a_failed_group_or_role_is_partial():
+    groups = {'g1': ['a1', 'a2', 'a3'], 'g2': ['b1', 'b2', 'b3', 'b4'], 'g3': ['c1']}
+    client = FakeGraphClient([policy('p1', groups=list(groups), roles=['r1', 'r2'])], groups, roles={'r1': ['x1'], 'r2': ['y1']})
+    client.fail['groups/g2/members?$select=id&$skiptoken=2'] = 500
+    client.fail["roleTemplateId='r2'"] = 503
+    helper = FakeHelper({'policy_name': '.', 'resumable_collection': '1'})
+    ew = RecordingEventWriter()
+
+    collector.ingest_exempted_users(helper, ew, client, 'tenant', 2)
+
+    [run_event] = ew.data(collector.RUN_SOURCETYPE)
+    assert run_event['status'] == 'partial'
+    assert (run_event['failedGroups'], run_event['failedRoles']) == (1, 1)
+    assert 'test_input_run_progress' not in helper.checkpoints
+
+
+def test_last_page_clears_the_saved_link():
+    helper = FakeHelper()
+    progress = collector.CollectionProgress(helper, RecordingEventWriter())
+
+    progress.page_written('g1', 'https://graph.microsoft.com/v1.0/groups/g1/members?$skiptoken=2')
+    progress.page_written('g1', None)
+
+    assert progress.next_links == {}
+
+
+def test_link_does_not_move_past_members_held_by_the_writer():
+    helper = FakeHelper()
+    progress = collector.CollectionProgress(helper, RecordingEventWriter())
+
+    progress.page_written('g1', 'https://graph.microsoft.com/v1.0/groups/g1/members?$skiptoken=2')
+    progress.page_written('g1', 'https://graph.microsoft.com/v1.0/groups/g1/members?$skiptoken=4', pending=True)
+    progress.page_written('g1', None, pending=True)
+
+    assert progress.next_links == {'g1': 'https://graph.microsoft.com/v1.0/groups/g1/members?$skiptoken=2'}
+
+
+def test_aggregated_run_resumes_without_losing_held_members(monkeypatch):
+    monkeypatch.setattr(collector, 'RUN_PROGRESS_SAVE_SECONDS', 0)
+    defaults = list(collector.AggregatedMemberEventWriter.__init__.__defaults__)
+    defaults[0] = 3
+    monkeypatch.setattr(collector.AggregatedMemberEventWriter.__init__, '__defaults__', tuple(defaults))
+    groups = {'g1': [f'a{i}' for i in range(8)]}
+    client = FakeGraphClient([policy('p1', groups=['g1'])], groups)
+    helper = FakeHelper({'policy_name': '.', 'resumable_collection': '1', 'event_schema': 'aggregated'})
+
+    # Chunks of 3 members over pages of 2: the second chunk is written while a3 is held from the second page.
+    first = InterruptingEventWriter(limit=1, sourcetype=collector.AGGREGATED_SOURCETYPE)
+    try:
+        collector.ingest_exempted_users(helper, first, client, 'tenant', 2)
+    except Interrupted:
+        pass
+
+    second = RecordingEventWriter()
+    collector.ingest_exempted_users(helper, second, client, 'tenant', 2)
+
+    written = [m for e in first.data(collector.AGGREGATED_SOURCETYPE) + second.data(collector.AGGREGATED_SOURCETYPE) for m in e['excludedUserIds']]
+    assert set(written) == set(groups['g1'])
@@ -0,0 +1,114 @@
+import cap_exempted_users_collector as collector
+
+from fakes import FakeGraphClient, FakeHelper, RecordingEventWriter, policy
+
+
+def run(helper, client):
+    ew = RecordingEventWriter()
+    collector.ingest_exempted_users(helper, ew, client, 'tenant', 4)
+    return [(e['policyId'], e['excludedUserMemberOf'], e['excludedUserState'], e['excludedUserId']) for e in ew.data()]
+
+
+def new_setup(group_count=120):
+    groups = {f'g{i:03d}': [f'g{i:03d}_u1', f'g{i:03d}_u2'] for i in range(group_count)}
+    client = FakeGraphClient([policy('p1', groups=list(groups))], groups)
+    helper = FakeHelper({'policy_name': '.', 'collection_mode': 'delta'})
+    return groups, client, helper
+
+
+def test_first_run_writes_every_member_as_baseline():
+    groups, client, helper = new_setup()
+
+    events = run(helper, client)
+
+    assert len(events) == 240
+    assert {state for _, _, state, _ in events} == {'Excluded from Policy via Group'}
+    assert len(client.requested('groups/delta')) == 3
+
+
+def test_unchanged_groups_write_nothing():
+    groups, client, helper = new_setup()
+    run(helper, client)
+
+    assert run(helper, client) == []
+    assert len(client.requested('$deltatoken')) == 3
+
+
+def test_membership_changes_are_written_as_changes():
+    groups, client, helper = new_setup()
+    run(helper, client)
+    groups['g001'].append('g001_u3')
+    groups['g002'].remove('g002_u1')
+
+    assert run(helper, client) == [
+        ('p1', 'g001', 'Added to Excluded Group', 'g001_u3'),
+        ('p1', 'g002', 'Removed from Excluded Group', 'g002_u1'),
+    ]
+
+
+def test_new_group_and_new_policy_do_not_start_new_baselines():
+    groups, client, helper = new_setup()
+    run(helper, client)
+    groups['new'] = ['new_u1', 'new_u2', 'new_u3']
+    client.policies = [policy('p1', groups=list(groups)), policy('p2', groups=['g005'])]
+    client.requests = []
+
+    events = run(helper, client)
+
+    assert sorted(events) == [
+        ('p1', 'new', 'Excluded from Policy via Group', 'new_u1'),
+        ('p1', 'new', 'Excluded from Policy via Group', 'new_u2'),
+        ('p1', 'new', 'Excluded from Policy via Group', 'new_u3'),
+        ('p2', 'g005', 'Excluded from Policy via Group', 'g005_u1'),
+        ('p2', 'g005', 'Excluded from Policy via Group', 'g005_u2'),
+    ]
+    assert len(client.requested('$deltatoken')) == 3
+    assert len(client.requested('groups/delta')) == 4
+
+    groups['g005'].append('g005_u3')
+    assert sorted(run(helper, client)) == [
+        ('p1', 'g005', 'Added to Excluded Group', 'g005_u3'),
+        ('p2', 'g005', 'Added to Excluded Group', 'g005_u3'),
+    ]
+
+
+def test_removed_group_is_written_in_full_when_excluded_again():
+    groups, client, helper = new_setup(group_count=3)
+    run(helper, client)
+    client.policies = [policy('p1', groups=['g000', 'g002'])]
+    run(helper, client)
+    groups['g001'].append('g001_u3')
+    client.policies = [policy('p1', groups=list(groups))]
+
+    assert run(helper, client) == [
+        ('p1', 'g001', 'Excluded from Policy via Group', 'g001_u1'),
+        ('p1', 'g001', 'Excluded from Policy via Group', 'g001_u2'),
+        ('p1', 'g001', 'Excluded from Policy via Group', 'g001_u3'),
+    ]
+
+
+def test_failed_chunk_keeps_its_delta_link():
+    groups, client, helper = new_setup(group_count=3)
+    run(helper, client)
+    groups['g001'].append('g001_u3')
+    client.fail['$deltatoken=0'] = 500
+
+    assert run(helper, client) == []
+
+    del client.fail['$deltatoken=0']
+    assert run(helper, client) == [('p1', 'g001', 'Added to Excluded Group', 'g001_u3')]
+
+
+def test_failed_full_read_is_retried_by_the_next_run():
+    groups, client, helper = new_setup(group_count=3)
+    run(helper, client)
+    client.policies = [policy('p1', groups=list(groups)), policy('p2', groups=['g001'])]
+    client.fail['groups/g001/members'] = 500
+
+    assert run(helper, client) == []
+
+    del client.fail['groups/g001/members']
+    assert run(helper, client) == [
+        ('p2', 'g001', 'Excluded from Policy via Group', 'g001_u1'),
+        ('p2', 'g001', 'Excluded from Policy via Group', 'g001_u2'),
+    ]
@@ -0,0 +1,81 @@
+import json
+import time
+
+import cap_exempted_users_collector as collector
+
+from fakes import FakeGraphClient, FakeHelper, FileCheckpointHelper, RecordingEventWriter, RecordingSerializer, guid, policy
+
+GROUP = {'policyId': 'p1', 'policyDisplayName': 'Policy p1', 'policyState': 'enabled', 'policyLastModifiedDateTime': '2024-01-01T00:00:00Z'}
+
+
+def aggregated_writer(client=None, **kwargs):
+    resolver = collector.DirectoryObjectResolver(FakeHelper(), client) if client is not None else None
+    ew = RecordingEventWriter()
+    return ew, collector.AggregatedMemberEventWriter(ew, RecordingSerializer(collector.AGGREGATED_SOURCETYPE), resolver=resolver, **kwargs)
+
+
+def test_aggregated_chunks_are_limited_by_member_count():
+    ew, writer = aggregated_writer(max_members=3)
+
+    writer.write(GROUP, 'g1', 'Excluded from Policy via Group', ['a1', 'a2'])
+    writer.write(GROUP, 'g1', 'Excluded from Policy via Group', ['a3', 'a4'])
+    writer.end()
+
+    chunks = ew.data(collector.AGGREGATED_SOURCETYPE)
+    assert [(c['excludedUserChunk'], c['excludedUserIds']) for c in chunks] == [(1, ['a1', 'a2', 'a3']), (2, ['a4'])]
+
+
+def test_enriched_aggregated_chunks_are_limited_by_size():
+    members = [f'a{i}' for i in range(60)]
+    client = FakeGraphClient(objects={m: {'displayName': m, 'userPrincipalName': m + '@' + 'x' * 60 + '.example.com'} for m in members})
+    ew, writer = aggregated_writer(client, max_bytes=2000)
+
+    writer.write(GROUP, 'g1', 'Excluded from Policy via Group', members)
+    writer.end()
+
+    events = [data for st, data in ew.events]
+    chunks = [json.loads(data) for data in events]
+    assert len(chunks) > 1
+    assert all(len(data) <= 2000 for data in events)
+    assert [m for c in chunks for m in c['excludedUserIds']] == members
+    assert [u for c in chunks for u in c['excludedUserPrincipalNames']] == [m + '@' + 'x' * 60 + '.example.com' for m in members]
+
+
+def test_role_template_ids_are_not_resolved():
+    client = FakeGraphClient([policy('p1', groups=['g1'], roles=['r1'])], {'g1': ['a1']}, roles={'r1': ['x1']},
+                             objects={'g1': {'displayName': 'Group 1'}, 'a1': {'userPrincipalName': 'a1@example.com'}})
+    helper = FakeHelper({'policy_name': '.', 'enrich_directory_objects': '1'})
+    ew = RecordingEventWriter()
+
+    collector.ingest_exempted_users(helper, ew, client, 'tenant', 2)
+
+    assert 'r1' not in client.resolved_ids
+    assert {'g1', 'a1', 'x1'} <= set(client.resolved_ids)
+    events = {e['excludedUserId']: e for e in ew.data()}
+    assert events['a1']['excludedUserMemberOfDisplayName'] == 'Group 1'
+    assert events['x1']['excludedUserMemberOfDisplayName'] is None
+
+
+def test_direct_users_and_role_members_are_resolved_in_one_call(tmp_path):
+    users = [guid(i) for i in range(25)]
+    client = FakeGraphClient([policy('p1', users=users, roles=['r1'])], roles={'r1': [guid(100), guid(101)]},
+                             objects={u: {'userPrincipalName': u + '@example.com'} for u in users})
+    helper = FileCheckpointHelper(str(tmp_path), {'policy_name': '.', 'enrich_directory_objects': '1'})
+    ew = RecordingEventWriter()
+
+    collector.ingest_exempted_users(helper, ew, client, 'tenant', 2)
+
+    assert len(client.requested('directoryObjects/getByIds')) == 2
+    assert [e['excludedUserPrincipalName'] for e in ew.data() if e['excludedUserId'] in users] == [u + '@example.com' for u in users]
+    assert helper.get_check_point('test_input_directory_objects_0')
+
+
+def test_expired_cache_entries_are_dropped():
+    now = int(time.time())
+    helper = FakeHelper(checkpoints={'test_input_directory_objects_0': {'0-old': [now - 1, 'Old', None, None], '0-new': [now + 60, 'New', None, None]}})
+    resolver = collector.DirectoryObjectResolver(helper, FakeGraphClient())
+
+    assert resolver.group_name('0-new') == 'New'
+    resolver.save()
+
+    assert helper.checkpoints['test_input_directory_objects_0'] == {'0-new': [now + 60, 'New', None, None]}
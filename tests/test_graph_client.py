@@ -0,0 +1,132 @@
+import threading
+import time
+from email.utils import formatdate
+
+import pytest
+import requests
+
+import cap_exempted_users_collector as collector
+
+from fakes import FakeHelper, FakeResponse
+
+
+class FakeSession(object):
+    """requests.Session answering each request with the next of responses; exceptions are raised."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def request(self, method, url, headers=None, **kwargs):
+        self.calls.append((method, url, headers))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def close(self):
+        pass
+
+
+def response(status_code, retry_after=None):
+    r = FakeResponse(status_code, {})
+    if retry_after is not None:
+        r.headers['Retry-After'] = retry_after
+    return r
+
+
+def new_client(responses, max_concurrency=4):
+    helper = FakeHelper()
+    client = collector.GraphClient(helper, pool_size=max_concurrency)
+    client.session = FakeSession(responses)
+    client.set_access_token('token')
+    return helper, client
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(collector, 'BACKOFF_BASE_SECONDS', 0)
+
+
+def test_retry_after_is_parsed_from_seconds_and_http_dates():
+    assert collector.parse_retry_after('7') == 7
+    assert collector.parse_retry_after('-3') == 0
+    assert 25 < collector.parse_retry_after(formatdate(time.time() + 30, usegmt=True)) <= 30
+    assert collector.parse_retry_after('soon') is None
+    assert collector.parse_retry_after(None) is None
+
+
+def test_throttled_request_waits_for_retry_after_and_is_retried():
+    helper, client = new_client([response(429, '0.3'), response(200)])
+
+    started = time.time()
+    result = client.get('groups/g1/members')
+
+    assert result.status_code == 200
+    assert time.time() - started >= 0.3
+    assert len(client.session.calls) == 2
+    assert client.session.calls[0][2]['Authorization'] == 'Bearer token'
+    assert any(level == 'WARNING' for level, msg in helper.logs)
+
+
+def test_throttling_halves_concurrency_and_success_grows_it_back():
+    controller = collector.GraphRateController(8)
+
+    controller.on_throttle(0, retry_after=0)
+    controller.on_throttle(0, retry_after=0)
+    assert controller.limit == 2
+
+    for _ in range(100):
+        controller.on_success()
+    assert controller.limit == 8
+
+
+def test_request_is_given_up_after_max_retries():
+    helper, client = new_client([response(503, '0')] * (collector.DEFAULT_MAX_RETRIES + 1))
+
+    assert client.get('groups/g1/members').status_code == 503
+    assert len(client.session.calls) == collector.DEFAULT_MAX_RETRIES + 1
+    assert any(level == 'ERROR' for level, msg in helper.logs)
+
+
+def test_retry_waiting_past_the_deadline_is_not_made():
+    helper, client = new_client([response(429, '120'), response(200)])
+    client.deadline = time.time() + 60
+
+    assert client.get('groups/g1/members').status_code == 429
+    assert len(client.session.calls) == 1
+
+
+def test_connection_errors_are_retried():
+    helper, client = new_client([requests.ConnectionError('reset'), response(200)])
+
+    assert client.get('groups/g1/members').status_code == 200
+    assert len(client.session.calls) == 2
+
+
+def test_requests_outside_graph_are_not_retried_and_carry_no_token():
+    helper, client = new_client([response(429)])
+
+    assert client.post('https://login.microsoftonline.com/tenant/oauth2/v2.0/token').status_code == 429
+    assert client.session.calls == [('POST', 'https://login.microsoftonline.com/tenant/oauth2/v2.0/token', None)]
+
+
+def test_workers_wait_while_requests_are_paused():
+    controller = collector.GraphRateController(4)
+    controller.on_throttle(0, retry_after=0.3)
+    acquired = []
+
+    def worker():
+        controller.acquire()
+        acquired.append(time.time())
+        controller.release()
+
+    started = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(acquired) == 3
+    assert min(acquired) - started >= 0.3
@@ -0,0 +1,113 @@
+import time
+
+import cap_exempted_users_collector as collector
+
+from fakes import FakeGraphClient, FakeHelper, slow_down
+
+
+def members(n, prefix):
+    return [f'{prefix}_u{i}' for i in range(n)]
+
+
+def read_all(stream):
+    return [(gid, [m['id'] for page in pages for m in page]) for gid, pages in stream]
+
+
+def test_groups_are_handed_out_in_order():
+    groups = {f'g{i}': members(i % 7, f'g{i}') for i in range(45)}
+    client = FakeGraphClient(groups=groups)
+    # The first chunk answers last, so later chunks are read before the group being consumed.
+    slow_down(client, 'groups/g0/', 0.2)
+
+    stream = collector.OrderedGroupPageStream(FakeHelper(), client, list(groups), max_concurrency=4)
+
+    assert read_all(stream) == list(groups.items())
+    assert not stream.incomplete_groups
+
+
+def test_first_pages_are_read_in_batches():
+    groups = {f'g{i}': members(1, f'g{i}') for i in range(25)}
+    client = FakeGraphClient(groups=groups)
+
+    read_all(collector.OrderedGroupPageStream(FakeHelper(), client, list(groups), max_concurrency=2))
+
+    assert len(client.requested('$batch')) == 2
+
+
+def test_failed_page_marks_group_incomplete():
+    groups = {'g1': members(3, 'g1'), 'g2': members(6, 'g2'), 'g3': members(3, 'g3')}
+    client = FakeGraphClient(groups=groups)
+    client.fail['groups/g2/members?$select=id&$skiptoken=4'] = 500
+
+    stream = collector.OrderedGroupPageStream(FakeHelper(), client, list(groups), max_concurrency=2)
+
+    assert read_all(stream) == [('g1', groups['g1']), ('g2', groups['g2'][:4]), ('g3', groups['g3'])]
+    assert stream.incomplete_groups == {'g2'}
+
+
+def test_group_failing_on_its_first_page_yields_no_members():
+    client = FakeGraphClient(groups={'g1': members(3, 'g1')})
+
+    stream = collector.OrderedGroupPageStream(FakeHelper(), client, ['missing', 'g1'], max_concurrency=2)
+
+    assert read_all(stream) == [('missing', []), ('g1', members(3, 'g1'))]
+    assert stream.incomplete_groups == {'missing'}
+
+
+def test_closing_the_stream_stops_the_workers():
+    groups = {f'g{i}': members(40, f'g{i}') for i in range(40)}
+    client = FakeGraphClient(groups=groups)
+    stream = collector.OrderedGroupPageStream(FakeHelper(), client, list(groups), max_concurrency=4)
+
+    started = time.time()
+    iterator = iter(stream)
+    gid, pages = next(iterator)
+    next(pages)
+    iterator.close()
+
+    assert stream.cancelled.is_set()
+    assert time.time() - started < 5
+    request_count = len(client.requests)
+    time.sleep(0.2)
+    assert len(client.requests) == request_count
+    assert request_count < 40 * 20
+
+
+def test_resumes_groups_from_saved_links():
+    groups = {'g1': members(6, 'g1'), 'g2': members(6, 'g2')}
+    client = FakeGraphClient(groups=groups)
+    start_links = {'g1': collector.GRAPH_URL + 'groups/g1/members?$select=id&$skiptoken=4'}
+    stream = collector.OrderedGroupPageStream(FakeHelper(), client, list(groups), 2, start_links=start_links)
+
+    links = []
+    result = []
+    for gid, pages in stream:
+        for page in pages:
+            result.extend(m['id'] for m in page)
+            links.append(stream.next_link(gid))
+
+    assert result == groups['g1'][4:] + groups['g2']
+    assert not client.requested('groups/g1/members?$select=id&$top')
+    assert links == [None, collector.GRAPH_URL + 'groups/g2/members?$select=id&$skiptoken=2',
+                     collector.GRAPH_URL + 'groups/g2/members?$select=id&$skiptoken=4', None]
+
+
+def test_rejected_saved_link_reads_group_from_its_first_page():
+    client = FakeGraphClient(groups={'g1': members(6, 'g1')})
+    client.fail['expired'] = 400
+    start_links = {'g1': collector.GRAPH_URL + 'groups/g1/members?$select=id&$skiptoken=4&expired=1'}
+
+    stream = collector.OrderedGroupPageStream(FakeHelper(), client, ['g1'], 1, start_links=start_links)
+
+    assert read_all(stream) == [('g1', members(6, 'g1'))]
+    assert not stream.incomplete_groups
+
+
+def test_groups_not_read_before_the_deadline_are_incomplete():
+    client = FakeGraphClient(groups={'g1': members(3, 'g1'), 'g2': members(3, 'g2')})
+
+    stream = collector.OrderedGroupPageStream(FakeHelper(), client, ['g1', 'g2'], 2, deadline=time.time() - 1)
+
+    assert read_all(stream) == [('g1', []), ('g2', [])]
+    assert stream.incomplete_groups == {'g1', 'g2'}
+    assert not client.requests
@@ -0,0 +1,139 @@
+import gzip
+import io
+import json
+import threading
+import time
+
+import pytest
+
+from splunklib import binding
+
+import cap_exempted_users_collector as collector
+
+from fakes import FakeHelper
+
+
+class FakeHec(object):
+    """Stands in for PipelinedHECEventWriter: records the batches posted, optionally holding them until released."""
+
+    def __init__(self):
+        self.payloads = []
+        self.released = threading.Event()
+        self.released.set()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.fail = None
+
+    def post_batch(self, payload, compress=False):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        self.released.wait(5)
+        with self.lock:
+            self.active -= 1
+        if self.fail is not None:
+            raise self.fail
+        self.payloads.append((payload, compress))
+
+
+@pytest.fixture
+def hec(monkeypatch):
+    hec = FakeHec()
+    monkeypatch.setattr(collector, 'PipelinedHECEventWriter', lambda *args, **kwargs: hec)
+    return hec
+
+
+def write_events(writer, count):
+    serializer = writer.new_serializer(source='src', sourcetype='st', index='main')
+    for i in range(count):
+        writer.write_serialized_event(serializer.serialize(json.dumps({'n': i})))
+
+
+def test_events_are_packed_into_batches_of_at_most_max_bytes(hec):
+    writer = collector.HecBatchEventWriter(FakeHelper(), 'hec_input', compress=True, max_bytes=200)
+
+    write_events(writer, 20)
+    writer.close()
+
+    assert len(hec.payloads) > 1
+    assert all(len(payload.encode('utf-8')) <= 200 and compress for payload, compress in hec.payloads)
+    events = [json.loads(line) for payload, compress in hec.payloads for line in payload.split('\n')]
+    assert [json.loads(e['event'])['n'] for e in events] == list(range(20))
+    assert events[0]['sourcetype'] == 'st'
+
+
+def test_writes_block_once_max_in_flight_batches_are_posted(hec):
+    hec.released.clear()
+    writer = collector.HecBatchEventWriter(FakeHelper(), 'hec_input', max_in_flight=2, max_bytes=50)
+    writing = threading.Thread(target=write_events, args=(writer, 10))
+    writing.start()
+
+    time.sleep(0.3)
+    assert writing.is_alive()
+    assert hec.active == 2
+
+    hec.released.set()
+    writing.join(5)
+    writer.close()
+
+    assert hec.max_active == 2
+    assert sum(len(payload.split('\n')) for payload, compress in hec.payloads) == 10
+
+
+def test_failed_post_is_raised_by_flush(hec):
+    hec.fail = OSError('HEC is not reachable')
+    writer = collector.HecBatchEventWriter(FakeHelper(), 'hec_input')
+    write_events(writer, 3)
+
+    with pytest.raises(OSError):
+        writer.flush()
+
+
+class FakeRestClient(object):
+
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.posts = []
+
+    def post(self, endpoint, body=None, headers=None):
+        self.posts.append((endpoint, body, headers))
+        status = self.statuses.pop(0)
+        if status != 200:
+            raise binding.HTTPError(FakeHttpResponse(status))
+
+
+class FakeHttpResponse(object):
+
+    def __init__(self, status):
+        self.status = status
+        self.reason = 'error'
+        self.body = io.BytesIO(b'')
+        self.headers = []
+
+
+def new_pipelined_writer(statuses):
+    writer = collector.PipelinedHECEventWriter.__new__(collector.PipelinedHECEventWriter)
+    writer._rest_client = FakeRestClient(statuses)
+    writer.headers = [('Authorization', 'Splunk token')]
+    return writer
+
+
+def test_compressed_batch_is_retried_while_hec_is_busy(monkeypatch):
+    monkeypatch.setattr(collector.time, 'sleep', lambda seconds: None)
+    writer = new_pipelined_writer([503, 429, 200])
+
+    writer.post_batch('{"event":"a"}\n{"event":"b"}', compress=True)
+
+    endpoint, body, headers = writer._rest_client.posts[-1]
+    assert len(writer._rest_client.posts) == 3
+    assert gzip.decompress(body) == b'{"event":"a"}\n{"event":"b"}'
+    assert ('Content-Encoding', 'gzip') in headers
+
+
+def test_other_hec_errors_are_not_retried():
+    writer = new_pipelined_writer([400, 200])
+
+    with pytest.raises(binding.HTTPError):
+        writer.post_batch('{"event":"a"}')
+    assert len(writer._rest_client.posts) == 1
@@ -0,0 +1,129 @@
+import io
+import threading
+import time
+
+import pytest
+
+from splunklib.modularinput import Event, EventWriter
+
+import cap_exempted_users_collector as collector
+
+from fakes import RecordingEventWriter
+
+
+class CountingStream(io.StringIO):
+
+    def __init__(self):
+        super().__init__()
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+
+
+def test_buffered_events_match_the_splunklib_event_writer():
+    expected = CountingStream()
+    reference = EventWriter(output=expected)
+    stream = CountingStream()
+    ew = collector.BufferedEventWriter(EventWriter(output=stream), max_events=2)
+    serializer = ew.new_serializer(source='src', sourcetype='st', index='main')
+
+    for data in ['{"a":1}', '{"b":"<&>"}', '{"c":"é"}']:
+        reference.write_event(Event(data=data, source='src', sourcetype='st', index='main', unbroken=True, done=True))
+        ew.write_serialized_event(serializer.serialize(data))
+    ew.close()
+
+    assert stream.getvalue() == expected.getvalue()
+    assert stream.getvalue().count('<stream>') == 1
+    assert stream.flushes == 2
+
+
+def test_buffered_events_are_flushed_after_max_seconds():
+    stream = CountingStream()
+    ew = collector.BufferedEventWriter(EventWriter(output=stream), max_seconds=0)
+
+    ew.write_serialized_event(ew.new_serializer(sourcetype='st').serialize('{}'))
+
+    assert stream.flushes == 1
+    assert '<data>{}</data>' in stream.getvalue()
+
+
+class BlockingEventWriter(RecordingEventWriter):
+    """Recording writer whose writes wait until released, or fail with error once it is set."""
+
+    def __init__(self):
+        super().__init__()
+        self.released = threading.Event()
+        self.error = None
+
+    def write_serialized_event(self, serialized_event):
+        self.released.wait(5)
+        if self.error is not None:
+            raise self.error
+        super().write_serialized_event(serialized_event)
+
+
+def test_threaded_writer_keeps_the_order_of_events():
+    wrapped = RecordingEventWriter()
+    ew = collector.ThreadedEventWriter(wrapped, batch_events=3)
+
+    for i in range(10):
+        ew.write_serialized_event(('st', str(i)))
+    ew.close()
+
+    assert [data for st, data in wrapped.events] == [str(i) for i in range(10)]
+
+
+def test_threaded_writer_blocks_writes_once_its_queue_is_full():
+    wrapped = BlockingEventWriter()
+    ew = collector.ThreadedEventWriter(wrapped, batch_events=1, max_batches=2)
+    writing = threading.Thread(target=lambda: [ew.write_serialized_event(('st', str(i))) for i in range(10)])
+    writing.start()
+
+    time.sleep(0.3)
+    assert writing.is_alive()
+    assert ew.queue.full()
+
+    wrapped.released.set()
+    writing.join(5)
+    ew.close()
+
+    assert len(wrapped.events) == 10
+
+
+def test_threaded_writer_failure_is_raised_to_the_collecting_thread():
+    wrapped = BlockingEventWriter()
+    wrapped.error = OSError('stdout closed')
+    wrapped.released.set()
+    ew = collector.ThreadedEventWriter(wrapped, batch_events=1)
+
+    with pytest.raises(OSError):
+        for i in range(100):
+            ew.write_serialized_event(('st', str(i)))
+            time.sleep(0.01)
+    with pytest.raises(OSError):
+        ew.close()
+
+
+def test_threaded_writer_flushes_when_idle():
+    wrapped = RecordingEventWriter()
+    ew = collector.ThreadedEventWriter(wrapped, batch_events=100, max_seconds=0.1)
+
+    ew.write_serialized_event(('st', 'a'))
+    time.sleep(0.5)
+
+    assert wrapped.events == [('st', 'a')]
+    assert wrapped.flushes >= 1
+    ew.close()
+
+
+def test_threaded_writer_flush_waits_for_the_wrapped_writer():
+    wrapped = RecordingEventWriter()
+    ew = collector.ThreadedEventWriter(wrapped, batch_events=100, max_seconds=60)
+
+    ew.write_serialized_event(('st', 'a'))
+    ew.flush()
+
+    assert wrapped.events == [('st', 'a')]
+    assert wrapped.flushes == 1
+    ew.close()
@@ -0,0 +1,79 @@
+import cap_exempted_users_collector as collector
+
+from fakes import FakeGraphClient, FakeHelper, RecordingEventWriter, policy
+
+CKPT_KEY = 'test_input_policy_index'
+
+
+def run(helper, client):
+    ew = RecordingEventWriter()
+    collector.ingest_exempted_users(helper, ew, client, 'tenant', 2)
+    return [p['id'] for p in ew.data('azure:aad:policy')]
+
+
+def new_setup(interval='86400'):
+    client = FakeGraphClient([policy('p1'), policy('p2'), policy('p3')])
+    helper = FakeHelper({'policy_name': '.', 'policy_snapshot_interval': interval})
+    return client, helper
+
+
+def test_only_new_and_modified_policies_are_written():
+    client, helper = new_setup()
+
+    assert run(helper, client) == ['p1', 'p2', 'p3']
+    assert run(helper, client) == []
+
+    client.policies[1]['modifiedDateTime'] = '2024-02-01T00:00:00Z'
+    client.policies.append(policy('p4'))
+    assert run(helper, client) == ['p2', 'p4']
+    assert run(helper, client) == []
+
+
+def test_policies_never_modified_are_compared_by_content():
+    client, helper = new_setup()
+    del client.policies[0]['modifiedDateTime']
+    run(helper, client)
+
+    assert run(helper, client) == []
+
+    client.policies[0]['state'] = 'disabled'
+    assert run(helper, client) == ['p1']
+
+
+def test_every_policy_is_written_once_the_interval_has_passed():
+    client, helper = new_setup(interval='3600')
+    run(helper, client)
+    helper.checkpoints[CKPT_KEY]['last_full_snapshot'] -= 3600
+
+    assert run(helper, client) == ['p1', 'p2', 'p3']
+    assert run(helper, client) == []
+
+
+def test_without_an_interval_every_policy_is_written_on_every_run():
+    client, helper = new_setup(interval='')
+
+    assert run(helper, client) == ['p1', 'p2', 'p3']
+    assert run(helper, client) == ['p1', 'p2', 'p3']
+    assert CKPT_KEY not in helper.checkpoints
+
+
+class FailingEventWriter(RecordingEventWriter):
+    """Fails on the first member event, after the policy events were written."""
+
+    def write_serialized_event(self, serialized_event):
+        if serialized_event[0] == 'azure:aad:user:capexempts':
+            raise OSError('output closed')
+        super().write_serialized_event(serialized_event)
+
+
+def test_index_is_not_saved_when_the_run_fails():
+    client, helper = new_setup()
+    client.policies[0] = policy('p1', users=['u1'])
+
+    try:
+        collector.ingest_exempted_users(helper, FailingEventWriter(), client, 'tenant', 2)
+    except OSError:
+        pass
+
+    assert CKPT_KEY not in helper.checkpoints
+    assert run(helper, client) == ['p1', 'p2', 'p3']
@@ -0,0 +1,31 @@
+import configparser
+import os
+
+import cap_exempted_users_collector as collector
+
+PROPS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'TA-microsoft_azure_cap_exempted_users', 'default', 'props.conf')
+
+
+def load_props():
+    props = configparser.ConfigParser(interpolation=None, strict=False)
+    props.optionxform = str
+    props.read(PROPS)
+    return props
+
+
+def test_sourcetypes_written_by_the_collector_extract_json_at_search_time():
+    props = load_props()
+
+    for sourcetype in (collector.AGGREGATED_SOURCETYPE, collector.SUMMARY_SOURCETYPE, collector.RUN_SOURCETYPE):
+        stanza = props[sourcetype]
+        assert stanza.get('KV_MODE') == 'json'
+        assert 'AUTO_KV_JSON' not in stanza
+        # Splunk silently ignores the misspelled INDEXED_EXTRACTION.
+        assert 'INDEXED_EXTRACTION' not in stanza
+
+
+def test_events_larger_than_the_default_truncate_fit_their_sourcetype():
+    props = load_props()
+
+    for sourcetype in (collector.AGGREGATED_SOURCETYPE, collector.SUMMARY_SOURCETYPE):
+        assert int(props[sourcetype]['TRUNCATE']) > collector.EVENT_MAX_BYTES
@@ -0,0 +1,106 @@
+import cap_exempted_users_collector as collector
+
+from fakes import FakeGraphClient, FakeHelper, FileCheckpointHelper, RecordingEventWriter, guid, policy
+
+U = [guid(i) for i in range(10)]
+
+
+def run(helper, client):
+    ew = RecordingEventWriter()
+    collector.ingest_exempted_users(helper, ew, client, 'tenant', 2)
+    return [(e['policyId'], e['excludedUserMemberOf'], e['excludedUserState'], e['excludedUserId']) for e in ew.data()]
+
+
+def new_setup(mode='snapshot'):
+    groups = {'g1': U[0:3], 'g2': U[3:5]}
+    client = FakeGraphClient([policy('p1', users=[U[9]], groups=['g1', 'g2'], roles=['r1']), policy('p2', groups=['g1'])],
+                             groups, roles={'r1': [U[8]]})
+    helper = FakeHelper({'policy_name': '.', 'collection_mode': mode})
+    return groups, client, helper
+
+
+def test_first_run_writes_every_member_and_unchanged_runs_nothing():
+    groups, client, helper = new_setup()
+
+    assert len(run(helper, client)) == 1 + 1 + 3 + 2 + 3
+    assert run(helper, client) == []
+
+
+def test_snapshots_are_saved_through_the_solnlib_checkpointer(tmp_path):
+    groups, client, helper = new_setup()
+    helper = FileCheckpointHelper(str(tmp_path), helper.args)
+    run(helper, client)
+    groups['g2'] = U[3:6]
+
+    assert run(helper, client) == [('p1', 'g2', 'Added to Excluded Group', U[5])]
+
+
+def test_membership_changes_are_written_for_every_policy():
+    groups, client, helper = new_setup()
+    run(helper, client)
+    groups['g1'] = U[1:4]
+
+    assert run(helper, client) == [
+        ('p1', 'g1', 'Added to Excluded Group', U[3]),
+        ('p1', 'g1', 'Removed from Excluded Group', U[0]),
+        ('p2', 'g1', 'Added to Excluded Group', U[3]),
+        ('p2', 'g1', 'Removed from Excluded Group', U[0]),
+    ]
+
+
+def test_policy_no_longer_excluding_a_group_gets_its_members_as_removed():
+    groups, client, helper = new_setup()
+    run(helper, client)
+    client.policies[1] = policy('p2', groups=[])
+
+    assert run(helper, client) == [('p2', 'g1', 'Removed from Excluded Group', m) for m in U[0:3]]
+    assert run(helper, client) == []
+
+
+def test_group_no_longer_excluded_is_removed_and_forgotten():
+    groups, client, helper = new_setup()
+    run(helper, client)
+    client.policies[0] = policy('p1', users=[U[9]], groups=['g1'], roles=['r1'])
+
+    assert run(helper, client) == [('p1', 'g2', 'Removed from Excluded Group', m) for m in U[3:5]]
+    assert 'test_input_snapshot_g2' not in helper.checkpoints
+
+    client.policies[1] = policy('p2', groups=['g1', 'g2'])
+    assert run(helper, client) == [('p2', 'g2', 'Excluded from Policy via Group', m) for m in U[3:5]]
+
+
+def test_removed_role_and_deleted_policy_are_written_as_removed():
+    groups, client, helper = new_setup()
+    run(helper, client)
+    client.policies = [policy('p2', groups=['g1'])]
+
+    assert sorted(run(helper, client)) == sorted(
+        [('p1', 'g1', 'Removed from Excluded Group', m) for m in U[0:3]] +
+        [('p1', 'g2', 'Removed from Excluded Group', m) for m in U[3:5]] +
+        [('p1', 'null', 'Removed from Policy Exclusions', U[9]), ('p1', 'r1', 'Removed from Excluded Directory Role', U[8])]
+    )
+
+
+def test_group_that_could_not_be_read_keeps_its_snapshot():
+    groups, client, helper = new_setup()
+    run(helper, client)
+    client.fail['groups/g2/'] = 500
+
+    assert run(helper, client) == []
+    assert 'test_input_snapshot_g2' in helper.checkpoints
+
+    del client.fail['groups/g2/']
+    groups['g2'] = U[3:6]
+    assert run(helper, client) == [('p1', 'g2', 'Added to Excluded Group', U[5])]
+
+
+def test_switching_to_delta_mode_does_not_remove_group_members():
+    groups, client, helper = new_setup()
+    run(helper, client)
+    helper.args['collection_mode'] = 'delta'
+
+    events = run(helper, client)
+
+    assert not [e for e in events if e[2].startswith('Removed')]
+    assert 'test_input_snapshot_g1' not in helper.checkpoints
+    assert 'test_input_snapshot_role_r1' in helper.checkpoints
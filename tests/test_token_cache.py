@@ -0,0 +1,91 @@
+import time
+
+import pytest
+
+import cap_exempted_users_collector as collector
+
+from fakes import FakeCredentialManager, FakeGraphClient, FakeHelper
+
+CKPT_KEY = 'access_token_tenant_client'
+CREDENTIAL = (collector.ACCESS_TOKEN_REALM, 'tenant_client')
+
+
+@pytest.fixture
+def passwords(monkeypatch):
+
+    class CredentialManager(FakeCredentialManager):
+        passwords = {}
+
+    monkeypatch.setattr(collector.credentials, 'CredentialManager', CredentialManager)
+    return CredentialManager.passwords
+
+
+def get_token(helper, client):
+    return collector.get_bearer_token(helper, client, 'client', 'secret', 'tenant')
+
+
+def test_token_is_kept_in_credential_storage_and_reused(passwords):
+    helper = FakeHelper()
+    client = FakeGraphClient()
+
+    first = get_token(helper, client)
+    second = get_token(FakeHelper(checkpoints=helper.checkpoints), client)
+
+    assert first == second
+    assert first[0] == 'token-1'
+    assert client.tokens_issued == 1
+    assert passwords == {CREDENTIAL: 'token-1'}
+    assert set(helper.checkpoints[CKPT_KEY]) == {'expires_on', 'fingerprint'}
+    assert 'token-1' not in str(helper.checkpoints)
+
+
+def test_token_close_to_expiry_is_refreshed(passwords):
+    helper = FakeHelper()
+    client = FakeGraphClient()
+    get_token(helper, client)
+    helper.checkpoints[CKPT_KEY]['expires_on'] = int(time.time()) + collector.TOKEN_EXPIRY_MARGIN - 1
+
+    access_token, expires_on = get_token(helper, client)
+
+    assert access_token == 'token-2'
+    assert expires_on > time.time() + 3000
+    assert passwords[CREDENTIAL] == 'token-2'
+
+
+def test_stored_token_not_matching_its_fingerprint_is_not_used(passwords):
+    helper = FakeHelper()
+    client = FakeGraphClient()
+    get_token(helper, client)
+    # Two inputs writing the chunked credential at the same time can leave parts of both tokens behind.
+    passwords[CREDENTIAL] = 'token-1 with the tail of another token'
+
+    assert get_token(helper, client)[0] == 'token-2'
+
+
+def test_missing_stored_token_is_requested_again(passwords):
+    helper = FakeHelper()
+    client = FakeGraphClient()
+    get_token(helper, client)
+    passwords.clear()
+
+    assert get_token(helper, client)[0] == 'token-2'
+    assert any(level == 'WARNING' for level, msg in helper.logs)
+
+
+def test_token_is_returned_when_it_cannot_be_stored(passwords, monkeypatch):
+
+    def set_password(self, user, password):
+        raise OSError('splunkd is not reachable')
+
+    monkeypatch.setattr(FakeCredentialManager, 'set_password', set_password)
+    helper = FakeHelper()
+
+    assert get_token(helper, FakeGraphClient())[0] == 'token-1'
+    assert CKPT_KEY not in helper.checkpoints
+
+
+def test_failed_token_request_returns_no_token(passwords):
+    client = FakeGraphClient()
+    client.fail['login.microsoftonline.com'] = 401
+
+    assert get_token(FakeHelper(), client) == (None, None)
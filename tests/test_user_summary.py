@@ -0,0 +1,93 @@
+import json
+
+import pytest
+
+import cap_exempted_users_collector as collector
+import input_module_conditional_access_policy_exempted_users as input_module
+
+from fakes import FakeGraphClient, FakeHelper, RecordingEventWriter, RecordingSerializer, policy
+
+
+class Definition(object):
+
+    def __init__(self, parameters):
+        self.parameters = parameters
+
+
+def test_summary_lists_every_path_of_a_user():
+    client = FakeGraphClient([policy('p1', users=['a1'], groups=['g1']), policy('p2', groups=['g1'])], {'g1': ['a1', 'a2']})
+    helper = FakeHelper({'policy_name': '.', 'user_summary': '1'})
+    ew = RecordingEventWriter()
+
+    collector.ingest_exempted_users(helper, ew, client, 'tenant', 2)
+
+    summaries = {e['excludedUserId']: e for e in ew.data(collector.SUMMARY_SOURCETYPE)}
+    assert summaries['a1']['policyIds'] == ['p1', 'p2']
+    assert summaries['a1']['exemptionCount'] == 3
+    assert summaries['a2']['exemptionCount'] == 2
+    assert 'exemptionChunk' not in summaries['a1']
+
+
+def test_exemptions_are_split_by_size():
+    summary = collector.ExemptUserSummary()
+    for i in range(40):
+        summary.add({'policyId': f'p{i}', 'policyDisplayName': 'Policy ' + 'x' * 100}, f'g{i}', 'Excluded from Policy via Group', ['a1'])
+    ew = RecordingEventWriter()
+
+    summary.write(ew, RecordingSerializer(collector.SUMMARY_SOURCETYPE), max_bytes=1000)
+
+    events = [data for st, data in ew.events]
+    chunks = [json.loads(data) for data in events]
+    assert len(chunks) > 1
+    assert all(len(data) <= 1000 for data in events)
+    assert [c['exemptionChunk'] for c in chunks] == list(range(len(chunks)))
+    assert all(c['exemptionCount'] == 40 and c['policyCount'] == 40 for c in chunks)
+    assert [x['policyId'] for c in chunks for x in c['exemptions']] == [f'p{i}' for i in range(40)]
+
+
+def test_summary_is_not_written_when_a_group_failed():
+    client = FakeGraphClient([policy('p1', groups=['g1', 'g2'])], {'g1': ['a1'], 'g2': ['b1']})
+    client.fail['groups/g2/'] = 500
+    helper = FakeHelper({'policy_name': '.', 'user_summary': '1', 'resumable_collection': '1'})
+    ew = RecordingEventWriter()
+
+    collector.ingest_exempted_users(helper, ew, client, 'tenant', 2)
+
+    assert ew.data(collector.SUMMARY_SOURCETYPE) == []
+    assert any(level == 'WARNING' and 'summary' in msg for level, msg in helper.logs)
+
+
+def test_summary_is_ignored_outside_the_full_collection_mode():
+    client = FakeGraphClient([policy('p1', groups=['g1'])], {'g1': ['a1']})
+    helper = FakeHelper({'policy_name': '.', 'user_summary': '1', 'collection_mode': 'snapshot'})
+    ew = RecordingEventWriter()
+
+    collector.ingest_exempted_users(helper, ew, client, 'tenant', 2)
+
+    assert ew.data(collector.SUMMARY_SOURCETYPE) == []
+
+
+@pytest.mark.parametrize('collection_mode', ['delta', 'snapshot'])
+def test_summary_requires_the_full_collection_mode(collection_mode):
+    with pytest.raises(ValueError):
+        input_module.validate_input(FakeHelper(), Definition({'user_summary': '1', 'collection_mode': collection_mode}))
+
+    input_module.validate_input(FakeHelper(), Definition({'user_summary': '0', 'collection_mode': collection_mode}))
+    input_module.validate_input(FakeHelper(), Definition({'user_summary': '1', 'collection_mode': 'full'}))
+
+
+def test_summary_is_ignored_for_sharded_inputs():
+    client = FakeGraphClient([policy('p1', groups=['g1', 'g2'])], {'g1': ['a1'], 'g2': ['b1']})
+    helper = FakeHelper({'policy_name': '.', 'user_summary': '1', 'shard_count': '2', 'shard_index': '0'})
+    ew = RecordingEventWriter()
+
+    collector.ingest_exempted_users(helper, ew, client, 'tenant', 2)
+
+    assert ew.data(collector.SUMMARY_SOURCETYPE) == []
+
+
+def test_summary_requires_a_single_input():
+    with pytest.raises(ValueError):
+        input_module.validate_input(FakeHelper(), Definition({'user_summary': '1', 'shard_count': '2', 'shard_index': '1'}))
+
+    input_module.validate_input(FakeHelper(), Definition({'user_summary': '1', 'shard_count': '1'}))